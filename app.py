@@ -1,24 +1,1494 @@
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, Request, request, jsonify, render_template_string, send_file, stream_with_context, g
 from flask_cors import CORS
 import os
+import re
+import hashlib
+import json
+import uuid
+import time
 import webbrowser
 import threading
+import base64
+import bisect
+import click
+import gzip
+import functools
+import random
+import mimetypes
+import http.client
+import zipfile
+import sqlite3
+import shutil
+import multiprocessing
+import concurrent.futures
+import contextlib
+from urllib.parse import urlsplit
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import wrap_file
+from werkzeug.http import http_date
 from datetime import datetime
 
+import processing
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo entre procesos
+    fcntl = None
+
+try:
+    import brotli
+except ImportError:  # Sin brotli sólo se sirve la variante gzip
+    brotli = None
+
+
+# Almacenamiento comprimido: el archivo 'x.txt' se guarda como 'x.txt~gz'.
+# secure_filename nunca produce '~', así que no choca con un nombre real.
+COMPRESSED_SUFFIX = '~gz'
+# Cabeceras de formatos que ya vienen comprimidos: se guardan tal cual
+COMPRESSED_MAGIC = (
+    b'\x1f\x8b',              # gzip
+    b'PK\x03\x04',            # zip, docx, xlsx, odt...
+    b'%PDF',                  # pdf
+    b'\xff\xd8\xff',          # jpeg
+    b'\x89PNG',               # png
+    b'GIF8',                  # gif
+    b'BZh',                   # bzip2
+    b'\xfd7zXZ\x00',          # xz
+    b'7z\xbc\xaf\x27\x1c',     # 7z
+    b'Rar!',                  # rar
+    b'\x28\xb5\x2f\xfd',      # zstd
+    b'OggS',                  # ogg
+    b'ID3',                   # mp3
+)
+
+def looks_compressed(data):
+    """Si los primeros bytes son de un formato ya comprimido"""
+    # mp4/mov llevan 'ftyp' tras el tamaño de la primera caja; webp va en RIFF
+    return data.startswith(COMPRESSED_MAGIC) or data[4:8] == b'ftyp' or data[8:12] == b'WEBP'
+
+def stored_name(name, compressed):
+    return name + COMPRESSED_SUFFIX if compressed else name
+
+def logical_name(name):
+    """Nombre visible de un archivo en disco (sin el sufijo de compresión)"""
+    return name[:-len(COMPRESSED_SUFFIX)] if name.endswith(COMPRESSED_SUFFIX) else name
+
+def gzip_size(path):
+    """Tamaño descomprimido según el final del gzip (ISIZE, módulo 4 GiB)"""
+    with open(path, 'rb') as f:
+        f.seek(-4, os.SEEK_END)
+        return int.from_bytes(f.read(4), 'little')
+
+
+class IngestFile:
+    """Archivo temporal dentro de la carpeta de uploads donde el parser
+    multipart escribe directamente cada parte. Calcula tamaño y SHA-256 en la
+    misma pasada y se publica con un rename, sin una segunda copia.
+    
+    Con compress=True el contenido se guarda en gzip rápido mientras llega,
+    salvo que los primeros bytes sean de un formato ya comprimido. `size` y
+    `sha256` son siempre los del contenido original.
+    
+    Al pasar de max_size se lanza RequestEntityTooLarge; con drain=True, en
+    cambio, se vacía lo escrito, se descarta el resto de la parte y queda
+    too_large=True para que el lote siga con las demás partes.
+    """
+    
+    def __init__(self, folder, max_size=None, compress=False, level=1, drain=False):
+        os.makedirs(folder, exist_ok=True)
+        self.path = os.path.join(folder, f'{uuid.uuid4().hex}.part')
+        self.max_size = max_size
+        self.drain = drain
+        self.too_large = False
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.write_time = 0.0  # segundos escribiendo en disco, para /metrics
+        self.compress = compress  # se decide con el primer bloque
+        self.level = level
+        self.compressed = False
+        self._gzip = None
+        self._file = open(self.path, 'wb')
+    
+    def write(self, data):
+        if self.too_large:
+            return len(data)
+        self.size += len(data)
+        # Límite por archivo comprobado mientras llega: no se espera al final del cuerpo
+        if self.max_size is not None and self.size > self.max_size:
+            if not self.drain:
+                raise RequestEntityTooLarge()
+            self.too_large = True
+            self._close_file()
+            open(self.path, 'wb').close()  # no ocupar disco con una parte que no se publica
+            return len(data)
+        self.sha256.update(data)
+        start = time.perf_counter()
+        if self.compress:
+            self.compress = False
+            if not looks_compressed(bytes(data[:16])):
+                self._gzip = gzip.GzipFile(fileobj=self._file, mode='wb', compresslevel=self.level, mtime=0)
+                self.compressed = True
+        written = (self._gzip or self._file).write(data)
+        self.write_time += time.perf_counter() - start
+        return written
+    
+    def seek(self, offset, whence=os.SEEK_SET):
+        # El parser llama a seek(0) al terminar cada parte: se libera el
+        # descriptor para que un lote de miles de archivos no agote los fds.
+        # Si luego alguien lee, _reader() reabre el archivo en modo lectura.
+        if self._file is not None and self._file.mode == 'wb':
+            self._close_file()
+        if self._file is None and offset == 0 and whence == os.SEEK_SET:
+            return 0
+        return self._reader().seek(offset, whence)
+    
+    def detach(self):
+        """Cerrar el archivo y devolver su ruta para publicarlo con un rename"""
+        self._close_file()
+        return self.path
+    
+    def close(self):
+        self._close_file()
+        # Lo que nadie publicó (errores, partes ignoradas) no se queda en disco
+        if os.path.exists(self.path):
+            os.remove(self.path)
+    
+    def _reader(self):
+        if self._file is None:
+            self._file = gzip.open(self.path, 'rb') if self.compressed else open(self.path, 'rb')
+        return self._file
+    
+    def _close_file(self):
+        if self._gzip is not None:
+            self._gzip.close()  # escribe el final del gzip; no cierra el archivo
+            self._gzip = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+    
+    def __getattr__(self, name):
+        return getattr(self._reader(), name)
+
+
+class UploadRequest(Request):
+    """Request que envía las partes de archivo a IngestFile en vez de a un
+    SpooledTemporaryFile"""
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # En un lote una parte demasiado grande no tumba las demás
+        stream = new_ingest_file(filename, drain=self.endpoint == 'upload_batch')
+        self.__dict__.setdefault('ingest_files', []).append(stream)
+        return stream
+    
+    def _load_form_data(self):
+        if 'form' in self.__dict__:
+            return
+        start = time.perf_counter()
+        try:
+            super()._load_form_data()
+        finally:
+            record_ingest(self.__dict__.get('ingest_files', []), time.perf_counter() - start)
+    
+    def close(self):
+        super().close()
+        # También se cierran las partes de un cuerpo que falló a mitad del parseo
+        for stream in self.__dict__.get('ingest_files', []):
+            stream.close()
+
+
+SHARD_RE = re.compile(r'^[0-9a-f]{2}$')
+
+def shard_dir(folder, filename):
+    """Subcarpeta de dos niveles (p. ej. 'ab/cd') según el hash del nombre"""
+    digest = hashlib.sha256(filename.encode('utf-8')).hexdigest()
+    return os.path.join(folder, digest[:2], digest[2:4])
+
+def scan_files(folder, sharded):
+    """Recorre con os.scandir los archivos visibles; devuelve pares (nombre
+    visible, DirEntry). entry.name es el nombre en disco (puede llevar ~gz)."""
+    if not sharded:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if not entry.name.startswith('.') and entry.is_file():
+                    yield logical_name(entry.name), entry
+        return
+    
+    with os.scandir(folder) as level1:
+        for dir1 in level1:
+            if not (SHARD_RE.match(dir1.name) and dir1.is_dir()):
+                continue
+            with os.scandir(dir1.path) as level2:
+                for dir2 in level2:
+                    if not (SHARD_RE.match(dir2.name) and dir2.is_dir()):
+                        continue
+                    with os.scandir(dir2.path) as entries:
+                        for entry in entries:
+                            if not entry.name.startswith('.') and entry.is_file():
+                                yield logical_name(entry.name), entry
+
+
+class FileIndex:
+    """Índice en memoria de los archivos visibles de la carpeta de uploads.
+    
+    Guarda tamaño y fecha de cada archivo y tres listas ordenadas de tuplas
+    (clave, nombre) para paginar por cursor sin tocar el disco. Las carpetas
+    internas (las que empiezan por '.') no se indexan. El tamaño es el del
+    contenido; de los archivos guardados comprimidos se anota aparte lo que
+    ocupan en disco.
+    """
+    
+    SORT_KEYS = ('name', 'size', 'modified')
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.files = {}
+        self.sorted = {key: [] for key in self.SORT_KEYS}
+        self.stored = {}  # nombre -> bytes en disco, sólo de los comprimidos
+        self.republished = set()  # nombres cuya fecha sale del registro y no del disco
+        self.total_bytes = 0  # bytes en disco, para la cuota
+        self.accessed = {}  # nombre -> última descarga (RETENTION_POLICY=lru)
+        self.cursor = None  # hasta dónde se aplicó el registro de cambios
+        # Cursor de la última entrada que cambió el listado (las 'get' de las
+        # descargas no cuentan): es el ETag de /files
+        self.version = None
+    
+    def rebuild(self, folder, sharded=False, published=None):
+        """Recorrer la carpeta una sola vez con os.scandir.
+        
+        `published` ({nombre: (tamaño, fecha)}, de ChangeLog.published) da la
+        fecha de publicación de cada nombre: la del disco no vale para los
+        enlaces a un blob, que comparten la del inodo con las subidas anteriores.
+        """
+        files = {}
+        stored = {}
+        republished = set()
+        published = published or {}
+        for name, entry in scan_files(folder, sharded):
+            stat = entry.stat()
+            if entry.name != name:
+                stored[name] = stat.st_size
+                size = gzip_size(entry.path)
+            else:
+                size = stat.st_size
+            mtime = stat.st_mtime
+            if name in published and published[name][0] == size:
+                mtime = published[name][1]
+                if abs(mtime - stat.st_mtime) > 1:
+                    republished.add(name)
+            files[name] = (size, mtime)
+        with self.lock:
+            self.files = files
+            self.republished = republished
+            self.stored = stored
+            self.total_bytes = sum(stored.get(name, size) for name, (size, _) in files.items())
+            self.accessed = {name: t for name, t in self.accessed.items() if name in files}
+            self.sorted = {
+                'name': sorted((name, name) for name in files),
+                'size': sorted((size, name) for name, (size, _) in files.items()),
+                'modified': sorted((mtime, name) for name, (_, mtime) in files.items()),
+            }
+    
+    def publish_entries(self):
+        """Entradas 'add' de los nombres cuya fecha de publicación no es la
+        del disco, para conservarlas al compactar el registro de cambios"""
+        with self.lock:
+            return [{'op': 'add', 'name': name, 'size': self.files[name][0], 'modified': self.files[name][1]}
+                    for name in self.republished if name in self.files]
+    
+    def add(self, name, size, mtime, stored_size=None):
+        with self.lock:
+            if name in self.files:
+                self._discard(name)
+            self.files[name] = (size, mtime)
+            if stored_size is not None:
+                self.stored[name] = stored_size
+            self.total_bytes += size if stored_size is None else stored_size
+            bisect.insort(self.sorted['name'], (name, name))
+            bisect.insort(self.sorted['size'], (size, name))
+            bisect.insort(self.sorted['modified'], (mtime, name))
+    
+    def remove(self, name):
+        with self.lock:
+            if name in self.files:
+                self._discard(name)
+    
+    def get(self, name):
+        """(tamaño, fecha) de un archivo o None si no está indexado"""
+        with self.lock:
+            return self.files.get(name)
+    
+    def stored_size(self, name):
+        """Bytes que ocupa en disco (None si no está indexado)"""
+        with self.lock:
+            meta = self.files.get(name)
+            return None if meta is None else self.stored.get(name, meta[0])
+    
+    def touch(self, name, when):
+        with self.lock:
+            if name in self.files:
+                self.accessed[name] = max(when, self.accessed.get(name, 0))
+    
+    def older_than(self, cutoff):
+        """Nombres de los archivos modificados antes de `cutoff`"""
+        with self.lock:
+            keys = self.sorted['modified']
+            return [name for _, name in keys[:bisect.bisect_left(keys, (cutoff,))]]
+    
+    def eviction_order(self, policy):
+        """Todos los nombres, primero los que antes deben borrarse: por fecha de
+        subida (age) o por última descarga (lru, o la subida si nunca se descargó)"""
+        with self.lock:
+            if policy == 'lru':
+                return sorted(self.files, key=lambda name: (
+                    max(self.accessed.get(name, 0), self.files[name][1]), name))
+            return [name for _, name in self.sorted['modified']]
+    
+    def _discard(self, name):
+        size, mtime = self.files.pop(name)
+        self.total_bytes -= self.stored.pop(name, size)
+        self.accessed.pop(name, None)
+        for key, value in (('name', name), ('size', size), ('modified', mtime)):
+            keys = self.sorted[key]
+            del keys[bisect.bisect_left(keys, (value, name))]
+    
+    def page(self, sort='name', descending=False, after=None, limit=None, extensions=None, prefix=None):
+        """Devuelve (archivos, última clave) a partir de la clave `after`"""
+        files = []
+        last = None
+        with self.lock:
+            keys = self.sorted[sort]
+            if descending:
+                pos = len(keys) if after is None else bisect.bisect_left(keys, after)
+                if prefix and sort == 'name':
+                    pos = min(pos, bisect.bisect_left(keys, (prefix + '\U0010ffff',)))
+                positions = range(pos - 1, -1, -1)
+            else:
+                pos = 0 if after is None else bisect.bisect_right(keys, after)
+                if prefix and sort == 'name':
+                    pos = max(pos, bisect.bisect_left(keys, (prefix,)))
+                positions = range(pos, len(keys))
+            
+            for i in positions:
+                key = keys[i]
+                name = key[1]
+                if prefix and not name.startswith(prefix):
+                    # Ordenado por nombre, el prefijo deja de coincidir para siempre
+                    if sort == 'name':
+                        break
+                    continue
+                if extensions and os.path.splitext(name)[1][1:].lower() not in extensions:
+                    continue
+                size, mtime = self.files[name]
+                files.append({'name': name, 'size': size, 'modified': mtime,
+                              'stored_size': self.stored.get(name, size)})
+                last = key
+                if limit is not None and len(files) >= limit:
+                    break
+        return files, last
+
+
+class ChangeLog:
+    """Registro de cambios de la carpeta de uploads en un archivo de sólo
+    anexado (una línea JSON por cambio).
+    
+    El cursor es '<id del registro>.<offset en bytes>': el offset crece con
+    cada cambio y el id cambia cuando el registro se compacta, de modo que un
+    cursor antiguo se detecta en vez de devolver cambios equivocados.
+    
+    Se compacta al arrancar y, en marcha, desde el limpiador. Cada anexado
+    toma un bloqueo compartido sobre el archivo y la compactación uno
+    exclusivo, así ninguna línea acaba en el archivo que se sustituye.
+    """
+    
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._ident = (None, None)
+    
+    def open(self, keep=()):
+        """Al arrancar: crear o compactar el registro y marcar el reinicio.
+        Al compactar se vuelven a escribir las entradas de `keep`."""
+        if not os.path.exists(self.path) or self.oversized():
+            self.compact(lambda entries: keep)
+        # El índice se acaba de reconstruir desde el disco: los clientes en
+        # modo delta deben volver a pedir el listado completo
+        self.append({'op': 'reset'})
+    
+    def oversized(self):
+        return os.path.getsize(self.path) > self.max_bytes
+    
+    def compact(self, keep=None):
+        """Reescribir el registro con un id nuevo. keep(entradas) devuelve las
+        entradas que se conservan; los cursores anteriores dejan de valer."""
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            f = None
+        try:
+            entries = []
+            if f is not None:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        continue  # línea a medio escribir
+            header = json.dumps({'op': 'journal', 'id': uuid.uuid4().hex}) + '\n'
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as tmp:
+                tmp.write(header)
+                for entry in (keep(entries) if keep else ()):
+                    tmp.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            os.replace(self.path + '.tmp', self.path)
+        finally:
+            if f is not None:
+                f.close()
+    
+    def append(self, entry):
+        line = (json.dumps(entry, separators=(',', ':')) + '\n').encode('utf-8')
+        while True:
+            with open(self.path, 'ab') as f:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+                    # Compactado mientras se esperaba: este inodo ya no es el registro
+                    if os.fstat(f.fileno()).st_ino != os.stat(self.path).st_ino:
+                        continue
+                f.write(line)
+                return
+    
+    def cursor(self):
+        stat = os.stat(self.path)
+        return f'{self._journal_id(stat)}.{stat.st_size}'
+    
+    def since(self, cursor):
+        """Devuelve (entradas, cursor nuevo) o (None, None) si el cursor no vale"""
+        changes, cursor = self.changes(cursor)
+        if changes is None:
+            return None, None
+        return [entry for entry, _ in changes], cursor
+    
+    def changes(self, cursor):
+        """Como since, pero con el cursor tras cada entrada: [(entrada, cursor)]"""
+        ident, _, offset = cursor.partition('.')
+        if not offset.isdigit():
+            return None, None
+        offset = int(offset)
+        
+        with open(self.path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if ident != self._journal_id(stat) or offset > stat.st_size:
+                return None, None
+            f.seek(offset)
+            data = f.read(stat.st_size - offset)
+        
+        # Sólo líneas completas; una escritura a medias se entrega la próxima vez
+        data = data[:data.rfind(b'\n') + 1]
+        changes = []
+        try:
+            for line in data.splitlines(keepends=True):
+                offset += len(line)
+                changes.append((json.loads(line), f'{ident}.{offset}'))
+        except ValueError:
+            return None, None
+        return changes, f'{ident}.{offset}'
+    
+    def published(self):
+        """{nombre: (tamaño, fecha de publicación)} de los 'add' aún vigentes"""
+        published = {}
+        try:
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # línea a medio escribir
+                    if entry['op'] == 'add':
+                        published[entry['name']] = (entry['size'], entry['modified'])
+                    elif entry['op'] == 'del':
+                        published.pop(entry['name'], None)
+        except FileNotFoundError:
+            pass
+        return published
+    
+    def _journal_id(self, stat):
+        # El id vive en la primera línea; se relee sólo si cambió el inodo
+        if self._ident[0] != stat.st_ino:
+            with open(self.path, 'rb') as f:
+                self._ident = (stat.st_ino, json.loads(f.readline())['id'])
+        return self._ident[1]
+
+
+JOB_RE = re.compile(r'^\d{13}-[0-9a-f]{32}\.json$')  # nombre de un trabajo de la cola de reenvío
+
+class RelayQueue:
+    """Cola en disco de archivos a reenviar al procesador externo (/upload_pdf).
+    
+    Cada trabajo es un JSON en pending/ cuyo nombre empieza por el instante
+    (ms) en que puede intentarse, así el orden alfabético es el orden de
+    envío. Un hilo lo reclama moviéndolo a inflight/ con un rename atómico,
+    lo que también sirve entre procesos. Cada hilo reutiliza su propia
+    conexión keep-alive. Tras RELAY_MAX_ATTEMPTS fallos el trabajo pasa a failed/.
+    Los JSON se escriben primero en tmp/, fuera del alcance de los hilos.
+    """
+    
+    def __init__(self, folder, url, workers, max_attempts, backoff):
+        self.folder = folder
+        self.url = url
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.wakeup = threading.Event()
+        for sub in ('pending', 'inflight', 'failed', 'tmp'):
+            os.makedirs(os.path.join(folder, sub), exist_ok=True)
+    
+    def enqueue(self, filename, attempts=0, delay=0):
+        job = {'name': filename, 'attempts': attempts}
+        ready = int((time.time() + delay) * 1000)
+        self._write(os.path.join(self.folder, 'pending', f'{ready:013d}-{uuid.uuid4().hex}.json'), job)
+        self.wakeup.set()
+    
+    def status(self):
+        return {sub: len(os.listdir(os.path.join(self.folder, sub)))
+                for sub in ('pending', 'inflight', 'failed')}
+    
+    def pending_names(self):
+        """Archivos que todavía esperan su envío y no deben borrarse"""
+        names = set()
+        for sub in ('pending', 'inflight'):
+            folder = os.path.join(self.folder, sub)
+            for name in os.listdir(folder):
+                try:
+                    with open(os.path.join(folder, name), 'r', encoding='utf-8') as f:
+                        names.add(json.load(f)['name'])
+                except (OSError, ValueError, KeyError):
+                    continue
+        return names
+    
+    def start(self):
+        self._recover()
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f'relay-{i}', daemon=True).start()
+    
+    def _recover(self):
+        """Devolver a la cola lo que quedó en curso en procesos que ya no existen"""
+        inflight = os.path.join(self.folder, 'inflight')
+        for name in os.listdir(inflight):
+            if not JOB_RE.match(name.split('-', 1)[-1]):
+                continue
+            pid = int(name.split('-', 1)[0])
+            try:
+                os.kill(pid, 0)
+                continue
+            except ProcessLookupError:
+                pass
+            except PermissionError:
+                continue
+            job_name = name.split('-', 1)[1]
+            try:
+                os.rename(os.path.join(inflight, name), os.path.join(self.folder, 'pending', job_name))
+            except FileNotFoundError:
+                pass
+    
+    def _claim(self):
+        pending = os.path.join(self.folder, 'pending')
+        now = int(time.time() * 1000)
+        for name in sorted(os.listdir(pending)):
+            if not JOB_RE.match(name):
+                continue
+            if int(name.split('-', 1)[0]) > now:
+                break
+            path = os.path.join(self.folder, 'inflight', f'{os.getpid()}-{name}')
+            try:
+                os.rename(os.path.join(pending, name), path)
+                return path
+            except FileNotFoundError:
+                continue  # otro hilo u otro proceso se lo llevó antes
+        return None
+    
+    def _worker(self):
+        # Conexión keep-alive propia del hilo; http.client reconecta solo si se cerró
+        url = urlsplit(self.url)
+        connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        conn = connection_class(url.hostname, url.port, timeout=60)
+        while True:
+            path = self._claim()
+            if path is None:
+                self.wakeup.wait(1)
+                self.wakeup.clear()
+                continue
+            
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    job = json.load(f)
+                try:
+                    self._send(conn, job['name'])
+                    os.remove(path)
+                except RelayError as e:
+                    self._retry(path, job, e)
+            except Exception:
+                # Un trabajo ilegible o un error inesperado no debe matar el hilo
+                app.logger.exception('Error en el reenvío de %s', os.path.basename(path))
+                try:
+                    os.replace(path, os.path.join(self.folder, 'failed', os.path.basename(path)))
+                except OSError:
+                    pass
+    
+    def _send(self, conn, filename):
+        """Envía el archivo como multipart, igual que el navegador"""
+        try:
+            source, size = open_logical(filename)
+        except FileNotFoundError:
+            raise RelayError('El archivo ya no existe', retry=False)
+        source.close()
+        
+        boundary = uuid.uuid4().hex
+        content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        head = (f'--{boundary}\r\n'
+                f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+                f'Content-Type: {content_type}\r\n\r\n').encode('utf-8')
+        tail = f'\r\n--{boundary}--\r\n'.encode('ascii')
+        
+        def body():
+            yield head
+            f, _ = open_logical(filename)
+            with f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    yield chunk
+            yield tail
+        
+        try:
+            conn.request('POST', urlsplit(self.url).path or '/', body=body(), headers={
+                'Content-Type': f'multipart/form-data; boundary={boundary}',
+                'Content-Length': str(len(head) + size + len(tail)),
+            })
+            response = conn.getresponse()
+            response.read()  # leer la respuesta entera para poder reutilizar la conexión
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            raise RelayError(f'Error de conexión: {e}')
+        
+        if response.status == 200:
+            return
+        # 4xx (salvo 408 y 429) no se arregla reintentando
+        retry = response.status >= 500 or response.status in (408, 429)
+        raise RelayError(f'Respuesta {response.status}', retry=retry)
+    
+    def _retry(self, path, job, error):
+        job['attempts'] += 1
+        job['error'] = str(error)
+        if not error.retry or job['attempts'] >= self.max_attempts:
+            app.logger.warning('Reenvío de %s abandonado: %s', job['name'], error)
+            self._write(os.path.join(self.folder, 'failed', os.path.basename(path)), job)
+        else:
+            # Espera exponencial con algo de azar para no reintentar todos a la vez
+            delay = min(300, self.backoff * 2 ** (job['attempts'] - 1)) * random.uniform(0.5, 1.5)
+            self.enqueue(job['name'], job['attempts'], delay)
+        os.remove(path)
+    
+    def _write(self, path, job):
+        # El temporal va en tmp/: en pending/ un hilo podría reclamarlo a medio escribir
+        tmp = os.path.join(self.folder, 'tmp', f'{os.getpid()}-{os.path.basename(path)}')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(job, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+
+class RelayError(Exception):
+    def __init__(self, message, retry=True):
+        super().__init__(message)
+        self.retry = retry
+
+
+def pid_alive(pid):
+    """Si el proceso sigue vivo (sólo se comprueba en POSIX)"""
+    if os.name != 'posix' or not pid.isdigit():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Metrics:
+    """Contadores e histogramas en memoria con salida en formato Prometheus.
+    
+    Cada operación es un incremento en un dict bajo un lock, barato para
+    dejarlo siempre activo. Cada proceso vuelca su copia en un archivo JSON
+    y /metrics suma las de todos los workers. Los contadores e histogramas
+    de un worker que termina se suman a archive.json, así los totales nunca
+    bajan; sólo sus gauges desaparecen con él.
+    """
+    
+    ARCHIVE = 'archive.json'
+    
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    HELP = {
+        'http_requests_total': ('counter', 'Peticiones atendidas por ruta, método y código'),
+        'http_request_duration_seconds': ('histogram', 'Duración de las peticiones a /upload y /files'),
+        'upload_received_bytes_total': ('counter', 'Bytes de archivo recibidos'),
+        'upload_ingest_seconds_total': ('counter', 'Tiempo leyendo y guardando cuerpos de subida'),
+        'upload_disk_write_seconds_total': ('counter', 'Parte del tiempo de ingesta escribiendo en disco'),
+        'upload_network_receive_seconds_total': ('counter', 'Parte del tiempo de ingesta esperando a la red y parseando'),
+        'uploads_in_flight': ('gauge', 'Subidas en curso'),
+        'upload_in_flight_bytes': ('gauge', 'Bytes admitidos de las subidas en curso'),
+        'processing_steps_total': ('counter', 'Pasos de post-procesado terminados por paso y resultado'),
+    }
+    
+    def __init__(self, folder, stale_after, gauges=None):
+        self.folder = folder
+        self.stale_after = stale_after
+        self.gauges = gauges  # función que devuelve los gauges actuales de este proceso
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.claimed = False  # si ya se comprobó que el archivo con nuestro pid es nuestro
+        self.counters = {}
+        self.histograms = {}
+    
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+    
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            counts = self.histograms.get(key)
+            if counts is None:
+                # Un contador por bucket (más +Inf), luego suma y total
+                counts = self.histograms[key] = [0] * (len(self.BUCKETS) + 3)
+            counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+            counts[-2] += value
+            counts[-1] += 1
+    
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': [[n, dict(l), v] for (n, l), v in self.counters.items()],
+                'histograms': [[n, dict(l), list(c)] for (n, l), c in self.histograms.items()],
+                'gauges': self.gauges() if self.gauges else {},
+            }
+    
+    def flush(self):
+        """Volcar la copia de este proceso para que la vean los demás workers"""
+        os.makedirs(self.folder, exist_ok=True)
+        path = os.path.join(self.folder, f'{os.getpid()}.json')
+        if not self.claimed:
+            # Un archivo con nuestro pid es de un worker anterior ya terminado
+            # (pid reutilizado): sus totales se archivan antes de pisarlo
+            with self._folder_lock():
+                if os.path.exists(path):
+                    self._archive(path)
+            self.claimed = True
+        # Con el lock una copia más antigua nunca sustituye a otra más nueva
+        with self.flush_lock:
+            self._write(path, self.snapshot())
+    
+    def collect(self):
+        """Sumar las copias volcadas por todos los workers y el archivo de los
+        que ya terminaron.
+        
+        La copia propia se vuelca antes de leer: cada lectura ve de cada
+        worker un valor igual o mayor que la anterior, la atienda el worker
+        que la atienda.
+        """
+        self.flush()
+        now = time.time()
+        snapshots = []
+        with self._folder_lock():
+            entries = [e for e in os.scandir(self.folder) if e.name.endswith('.json')]
+            # Primero se archivan los workers terminados y después se lee todo:
+            # así nada se cuenta dos veces ni se pierde a mitad de la lectura
+            for entry in entries:
+                if entry.name != self.ARCHIVE and not pid_alive(entry.name[:-5]):
+                    self._archive(entry.path)
+            for entry in os.scandir(self.folder):
+                if not entry.name.endswith('.json'):
+                    continue
+                try:
+                    snap = self._read(entry.path)
+                    # Los gauges de una copia sin actualizar ya no son actuales
+                    if now - entry.stat().st_mtime > self.stale_after:
+                        snap['gauges'] = {}
+                except (OSError, ValueError):
+                    continue
+                snapshots.append(snap)
+        return self._merge(snapshots)
+    
+    @staticmethod
+    def _merge(snapshots):
+        counters, histograms, gauges = {}, {}, {}
+        for snap in snapshots:
+            for name, labels, value in snap['counters']:
+                key = (name, tuple(sorted(labels.items())))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, counts in snap['histograms']:
+                key = (name, tuple(sorted(labels.items())))
+                total = histograms.setdefault(key, [0] * len(counts))
+                for i, value in enumerate(counts):
+                    total[i] += value
+            for name, value in snap.get('gauges', {}).items():
+                gauges[name] = gauges.get(name, 0) + value
+        return counters, histograms, gauges
+    
+    def _archive(self, path):
+        """Sumar a archive.json los contadores e histogramas de un worker
+        terminado y borrar su copia (con _folder_lock tomado)"""
+        archive_path = os.path.join(self.folder, self.ARCHIVE)
+        snapshots = []
+        for source in (archive_path, path):
+            try:
+                snapshots.append(self._read(source))
+            except (OSError, ValueError):
+                continue
+        counters, histograms, _ = self._merge(snapshots)
+        self._write(archive_path, {
+            'counters': [[n, dict(l), v] for (n, l), v in counters.items()],
+            'histograms': [[n, dict(l), c] for (n, l), c in histograms.items()],
+            'gauges': {},
+        })
+        os.remove(path)
+    
+    @contextlib.contextmanager
+    def _folder_lock(self):
+        """Bloqueo entre procesos para archivar y leer la carpeta a la vez"""
+        os.makedirs(self.folder, exist_ok=True)
+        with open(os.path.join(self.folder, '.lock'), 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            yield
+    
+    @staticmethod
+    def _read(path):
+        with open(path) as f:
+            return json.load(f)
+    
+    @staticmethod
+    def _write(path, data):
+        tmp = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+    
+    def render(self):
+        counters, histograms, gauges = self.collect()
+        lines = []
+        def header(name):
+            kind, text = self.HELP[name]
+            lines.append(f'# HELP {name} {text}')
+            lines.append(f'# TYPE {name} {kind}')
+        def fmt(labels):
+            if not labels:
+                return ''
+            return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+        
+        for name in self.HELP:
+            kind = self.HELP[name][0]
+            if kind == 'gauge':
+                header(name)
+                lines.append(f'{name} {gauges.get(name, 0)}')
+            elif kind == 'counter':
+                series = sorted((l, v) for (n, l), v in counters.items() if n == name)
+                header(name)
+                if not series and name != 'http_requests_total':
+                    series = [((), 0)]
+                for labels, value in series:
+                    lines.append(f'{name}{fmt(labels)} {value}')
+            else:
+                header(name)
+                for labels, counts in sorted((l, c) for (n, l), c in histograms.items() if n == name):
+                    cumulative = 0
+                    for bound, count in zip(self.BUCKETS + ('+Inf',), counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{fmt(labels + (("le", bound),))} {cumulative}')
+                    lines.append(f'{name}_sum{fmt(labels)} {counts[-2]}')
+                    lines.append(f'{name}_count{fmt(labels)} {counts[-1]}')
+        return '\n'.join(lines) + '\n'
+    
+    def start(self, interval):
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.flush()
+                except OSError:
+                    pass
+        threading.Thread(target=run, daemon=True, name='metrics-flush').start()
+
+
+class UploadAdmission:
+    """Control de admisión de subidas en este proceso.
+    
+    Limita las subidas simultáneas y los bytes en curso; lo que no cabe se
+    rechaza al momento (503) en vez de esperar en cola. Opcionalmente limita
+    las peticiones por cliente con un token bucket (429).
+    """
+    
+    def __init__(self, max_uploads, max_bytes, rate=0, burst=0):
+        self.max_uploads = max_uploads
+        self.max_bytes = max_bytes
+        self.rate = rate
+        self.burst = burst or 2 * rate
+        self.lock = threading.Lock()
+        self.uploads = 0
+        self.bytes = 0
+        self.buckets = {}
+    
+    def acquire(self, client, length):
+        """Devuelve None si se admite, o (código, segundos para reintentar)"""
+        with self.lock:
+            if self.rate:
+                wait = self._take_token(client)
+                if wait:
+                    return 429, wait
+            if self.uploads >= self.max_uploads or self.bytes + length > self.max_bytes:
+                return 503, None
+            self.uploads += 1
+            self.bytes += length
+            return None
+    
+    def release(self, length):
+        with self.lock:
+            self.uploads -= 1
+            self.bytes -= length
+    
+    def _take_token(self, client):
+        now = time.monotonic()
+        tokens, last = self.buckets.get(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self.buckets[client] = (tokens, now)
+            return (1 - tokens) / self.rate
+        self.buckets[client] = (tokens - 1, now)
+        # Los clientes que ya recuperaron todos sus tokens no hace falta recordarlos
+        if len(self.buckets) > 10000:
+            self.buckets = {c: (t, l) for c, (t, l) in self.buckets.items()
+                            if t + (now - l) * self.rate < self.burst}
+        return 0
+
+
+class Catalog:
+    """Catálogo SQLite de los archivos publicados (opcional).
+    
+    Guarda nombre, tamaño, fecha, SHA-256, tipo de contenido y nombre original,
+    con índices para consultar por rango de tamaño o fecha, prefijo y
+    extensión sin recorrer la carpeta. Una conexión por hilo, en modo WAL para
+    que varios procesos escriban a la vez.
+    """
+    
+    SORT_COLUMNS = {'name': 'name', 'size': 'size', 'modified': 'mtime'}
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            name TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            sha256 TEXT,
+            content_type TEXT,
+            original_name TEXT,
+            ext TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS files_ext_mtime ON files (ext, mtime);
+        CREATE INDEX IF NOT EXISTS files_size ON files (size);
+        CREATE INDEX IF NOT EXISTS files_mtime ON files (mtime);
+        CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256);
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        db = self.connect()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.executescript(self.SCHEMA)
+    
+    def connect(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+        return db
+    
+    def add(self, name, size, mtime, sha256=None, content_type=None, original_name=None):
+        with self.connect() as db:
+            self._insert(db, name, size, mtime, sha256, content_type, original_name)
+    
+    def _insert(self, db, name, size, mtime, sha256, content_type, original_name):
+        db.execute(
+            'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (name, size, mtime, sha256, content_type, original_name or name, file_extension(name))
+        )
+    
+    def remove(self, name):
+        with self.connect() as db:
+            db.execute('DELETE FROM files WHERE name = ?', (name,))
+    
+    def query(self, prefix=None, extensions=None, min_size=None, max_size=None,
+              after=None, before=None, sha256=None, content_type=None,
+              sort='name', descending=False, limit=100, offset=0):
+        where, params = [], []
+        if prefix:
+            # Rango sobre la clave primaria en vez de LIKE: usa el índice
+            where.append('name >= ? AND name < ?')
+            params += [prefix, prefix + '\U0010ffff']
+        if extensions:
+            where.append(f'ext IN ({", ".join("?" * len(extensions))})')
+            params += sorted(extensions)
+        for clause, value in (('size >= ?', min_size), ('size <= ?', max_size),
+                              ('mtime >= ?', after), ('mtime < ?', before),
+                              ('sha256 = ?', sha256), ('content_type = ?', content_type)):
+            if value is not None:
+                where.append(clause)
+                params.append(value)
+        
+        sql = 'SELECT name, size, mtime, sha256, content_type, original_name FROM files'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        column = self.SORT_COLUMNS[sort]
+        direction = 'DESC' if descending else 'ASC'
+        sql += f' ORDER BY {column} {direction}, name {direction} LIMIT ? OFFSET ?'
+        params += [limit, offset]
+        
+        return [{
+            'name': row['name'],
+            'size': row['size'],
+            'modified': row['mtime'],
+            'sha256': row['sha256'],
+            'content_type': row['content_type'],
+            'original_name': row['original_name'],
+        } for row in self.connect().execute(sql, params)]
+    
+    def rebuild(self, folder, sharded, rehash=False, published=None):
+        """Sincronizar el catálogo con la carpeta: añade lo nuevo, borra lo que
+        ya no existe y sólo recalcula el SHA-256 de lo que cambió. `published`
+        da las fechas de publicación como en FileIndex.rebuild."""
+        published = published or {}
+        db = self.connect()
+        known = {row['name']: row for row in db.execute('SELECT * FROM files')}
+        added = removed = 0
+        with db:
+            for name, entry in scan_files(folder, sharded):
+                stat = entry.stat()
+                compressed = entry.name != name
+                size = gzip_size(entry.path) if compressed else stat.st_size
+                mtime = stat.st_mtime
+                if name in published and published[name][0] == size:
+                    mtime = published[name][1]
+                row = known.pop(name, None)
+                # La fecha de publicación y la del disco difieren en milésimas
+                if row is not None and not rehash and row['sha256'] \
+                        and row['size'] == size and abs(row['mtime'] - mtime) <= 1:
+                    continue
+                self._insert(
+                    db, name, size, mtime, file_sha256(entry.path, compressed),
+                    row['content_type'] if row else mimetypes.guess_type(name)[0],
+                    row['original_name'] if row else name
+                )
+                added += 1
+            for name in known:
+                db.execute('DELETE FROM files WHERE name = ?', (name,))
+                removed += 1
+        return added, removed
+
+
+def file_extension(name):
+    return os.path.splitext(name)[1][1:].lower()
+
+
+class Janitor:
+    """Hilo que mantiene la carpeta de uploads dentro de la cuota y de la
+    antigüedad máxima, y borra las sesiones reanudables abandonadas.
+    
+    Decide con los tamaños y fechas del índice en memoria, sin recorrer la
+    carpeta. Sólo limpia un proceso a la vez: el que tiene .janitor.lock.
+    Los archivos pendientes de reenvío no se borran.
+    """
+    
+    def __init__(self, quota, max_age, policy, interval, lock_path):
+        self.quota = quota
+        self.max_age = max_age
+        self.policy = policy
+        self.interval = interval
+        self.lock_path = lock_path
+        self.lock_file = None
+        self.wakeup = threading.Event()
+    
+    def start(self):
+        threading.Thread(target=self._run, name='janitor', daemon=True).start()
+    
+    def trigger(self):
+        """Adelantar la siguiente pasada (p. ej. al acercarse a la cuota)"""
+        self.wakeup.set()
+    
+    def sweep(self):
+        """Una pasada: borra lo caducado y luego lo necesario para volver a la
+        cuota. Devuelve (archivos borrados, bytes liberados)"""
+        expire_sessions()
+        expire_incoming()
+        compact_logs()
+        sync_index()
+        protected = relay_queue.pending_names() if relay_queue is not None else set()
+        removed = freed = 0
+        
+        if self.max_age:
+            for name in file_index.older_than(time.time() - self.max_age):
+                if name not in protected:
+                    freed += delete_file(name)
+                    removed += 1
+        
+        if self.quota and file_index.total_bytes > self.quota:
+            for name in file_index.eviction_order(self.policy):
+                if file_index.total_bytes <= self.quota:
+                    break
+                if name not in protected:
+                    freed += delete_file(name)
+                    removed += 1
+        
+        if removed:
+            app.logger.info('Limpieza de uploads: %d archivos borrados, %d bytes liberados', removed, freed)
+        return removed, freed
+    
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            if not self._acquire():
+                continue
+            try:
+                self.sweep()
+            except Exception:
+                app.logger.exception('Error en la limpieza de uploads')
+    
+    def _acquire(self):
+        """Con varios procesos sólo limpia el que consigue el bloqueo (y lo conserva)"""
+        if fcntl is None or self.lock_file is not None:
+            return True
+        f = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self.lock_file = f
+        return True
+
+
+class PostProcessor:
+    """Post-procesado de los archivos publicados en un pool de procesos.
+    
+    Cada paso de processing.STEPS (tipo real, páginas de PDF, verificación
+    del SHA-256, contenido de zip/tar y los de PROCESSING_PLUGINS) se lanza
+    por separado. Los resultados se guardan en un JSON por archivo en .meta/
+    y el avance se anota en el registro de eventos que sirve /events. Si el
+    contenido no cambió (mismo SHA-256, o tamaño y fecha) lo ya calculado no
+    se repite. Lo que estaba en cola al parar el proceso no se retoma solo:
+    POST /files/<nombre>/meta lo vuelve a encolar.
+    """
+    
+    def __init__(self, folder, workers, plugins, events):
+        self.folder = folder
+        self.workers = workers
+        self.plugins = plugins
+        self.events = events
+        processing.load_plugins(plugins)
+        self.steps = list(processing.STEPS)
+        # Reentrante: add_done_callback llama a _finished en el acto si el paso ya terminó
+        self.lock = threading.RLock()
+        self.executor = None
+    
+    def start(self):
+        """Crear el pool (antes que los hilos del proceso, ver _new_executor)"""
+        with self.lock:
+            self._new_executor()
+        # Con fork todos los procesos nacen en el primer envío: que sea ahora
+        self.executor.submit(len, ()).result()
+    
+    def _new_executor(self):
+        # Con fork los procesos parten del worker ya cargado. Con spawn o
+        # forkserver cada uno importaría el módulo principal, y con
+        # 'python app.py' eso es app.py entero (índice, registro, hilos...)
+        method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            self.workers, multiprocessing.get_context(method),
+            initializer=processing.init_worker, initargs=(self.plugins, os.getpid()))
+    
+    def meta_path(self, name):
+        return os.path.join(shard_dir(self.folder, name), f'{name}.json')
+    
+    def load(self, name):
+        """Metadatos guardados de un archivo, o None"""
+        try:
+            with open(self.meta_path(name), encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+    
+    def _save(self, meta):
+        path = self.meta_path(meta['name'])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(tmp, path)
+    
+    def discard(self, name):
+        with self.lock:
+            try:
+                os.remove(self.meta_path(name))
+            except FileNotFoundError:
+                pass
+    
+    def submit(self, name, filepath, size, mtime, digest=None, force=False):
+        """Encolar los pasos que falten (o todos con `force`); devuelve sus nombres"""
+        key = digest or f'{size}:{mtime}'
+        info = {'name': name, 'size': size, 'sha256': digest,
+                'compressed': filepath.endswith(COMPRESSED_SUFFIX)}
+        with self.lock:
+            meta = self.load(name)
+            if force or meta is None or meta['key'] != key:
+                meta = {'name': name, 'key': key, 'results': {}}
+            # Los pasos que fallaron se reintentan
+            pending = [step for step in self.steps
+                       if step not in meta['results'] or failed(meta['results'][step])]
+            for step in pending:
+                meta['results'].pop(step, None)
+            self._save(meta)
+            self._emit('queued', {'name': name, 'steps': pending, 'total': len(self.steps)})
+            if not pending:
+                self._emit('done', {'name': name, 'summary': processing_summary(meta['results'])})
+                return pending
+            
+            for step in pending:
+                try:
+                    future = self.executor.submit(processing.run_step, step, filepath, info)
+                except concurrent.futures.BrokenExecutor:
+                    self._new_executor()
+                    future = self.executor.submit(processing.run_step, step, filepath, info)
+                future.add_done_callback(functools.partial(
+                    self._finished, self.executor, name, step, key, filepath))
+        return pending
+    
+    def _finished(self, executor, name, step, key, filepath, future):
+        broken = False
+        try:
+            result = future.result()
+            outcome = 'ok' if result is not None else 'skipped'
+        except concurrent.futures.BrokenExecutor:
+            # Un proceso del pool murió (p. ej. sin memoria con un archivo raro)
+            result = {'error': 'El proceso de post-procesado terminó de forma inesperada'}
+            outcome = 'error'
+            broken = True
+        except Exception as e:
+            result = {'error': f'{type(e).__name__}: {e}'}
+            outcome = 'error'
+        metrics.inc('processing_steps_total', step=step, outcome=outcome)
+        
+        with self.lock:
+            if broken and self.executor is executor:
+                self._new_executor()
+            # Borrado o reemplazado mientras tanto: el resultado ya no vale
+            meta = self.load(name)
+            if meta is None or meta['key'] != key or not os.path.exists(filepath):
+                return
+            meta['results'][step] = result
+            self._save(meta)
+            completed = sum(1 for s in self.steps if s in meta['results'])
+            self._emit('progress', {'name': name, 'step': step, 'ok': not failed(result),
+                                    'completed': completed, 'total': len(self.steps)})
+            if completed == len(self.steps):
+                self._emit('done', {'name': name, 'summary': processing_summary(meta['results'])})
+    
+    def _emit(self, event, data):
+        self.events.append({'op': 'event', 'event': event, 'data': data})
+
+
+def failed(result):
+    return isinstance(result, dict) and 'error' in result
+
+def processing_summary(results):
+    """Resumen corto de los resultados para la página (el detalle está en /files/<nombre>/meta)"""
+    summary = {'errors': sorted(step for step, result in results.items() if failed(result))}
+    mime = results.get('mime')
+    if mime and not failed(mime):
+        summary['mime'] = mime['detected']
+        summary['mime_matches'] = mime['matches']
+    checksum = results.get('checksum')
+    if checksum and not failed(checksum):
+        summary['verified'] = checksum['ok']
+    pdf = results.get('pdf_pages')
+    if pdf and pdf.get('pages') is not None:
+        summary['pages'] = pdf['pages']
+    archive = results.get('archive')
+    if archive and not failed(archive):
+        summary['entries'] = archive['count']
+    return summary
+
+
 app = Flask(__name__)
-CORS(app)
+app.request_class = UploadRequest
+CORS(app, expose_headers=['Retry-After'])
 
 # Configuración
 UPLOAD_FOLDER = 'uploads'
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50 MB por archivo
+RESUMABLE_MAX_SIZE = 2 * 1024 * 1024 * 1024  # 2 GB por archivo en subida reanudable
+CHUNK_SIZE = 1024 * 1024  # 1 MB por lectura del cuerpo
+MULTIPART_OVERHEAD = 16 * 1024  # margen para cabeceras y separadores de una parte
+# Formatos ya comprimidos: en el ZIP y en el almacenamiento comprimido se
+# guardan tal cual (sin gastar CPU en deflate)
+STORED_EXTENSIONS = {
+    'pdf', 'jpg', 'jpeg', 'png', 'gif', 'webp', 'zip', 'gz', 'tgz', 'bz2', 'xz', '7z', 'rar',
+    'mp3', 'mp4', 'mov', 'avi', 'mkv', 'docx', 'xlsx', 'pptx', 'odt', 'ods', 'odp'
+}
 
 # Crear carpeta de uploads si no existe
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['MAX_FILE_SIZE'] = MAX_FILE_SIZE
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100 MB total
+app.config['MAX_FORM_PARTS'] = 10000  # /upload/batch admite miles de archivos pequeños
+app.config['RESUMABLE_FOLDER'] = os.path.join(UPLOAD_FOLDER, '.sessions')
+app.config['RESUMABLE_MAX_SIZE'] = RESUMABLE_MAX_SIZE
+app.config['RESUMABLE_TTL'] = int(os.environ.get('RESUMABLE_TTL', 24 * 3600))  # segundos sin recibir bloques antes de caducar
+app.config['INCOMING_FOLDER'] = os.path.join(UPLOAD_FOLDER, '.incoming')
+# Una parte sin escribir en este tiempo es de un worker que murió a mitad de
+# la subida (despliegue, OOM...): el limpiador la borra
+app.config['INCOMING_MAX_AGE'] = int(os.environ.get('INCOMING_MAX_AGE', 3600))
+# Almacén por contenido (opcional): cada contenido se guarda una sola vez en
+# .blobs/ por su SHA-256 y los nombres visibles son enlaces duros al blob
+app.config['CAS_ENABLED'] = os.environ.get('CAS_ENABLED') == '1'
+app.config['BLOB_FOLDER'] = os.path.join(UPLOAD_FOLDER, '.blobs')
+# Admisión de subidas (por proceso): lo que excede se rechaza con 503 + Retry-After
+app.config['MAX_INFLIGHT_UPLOADS'] = int(os.environ.get('MAX_INFLIGHT_UPLOADS', 32))
+app.config['MAX_INFLIGHT_BYTES'] = int(os.environ.get('MAX_INFLIGHT_BYTES', 512 * 1024 * 1024))
+app.config['UPLOAD_RATE_LIMIT'] = float(os.environ.get('UPLOAD_RATE_LIMIT', 0))  # peticiones/s por cliente, 0 = sin límite
+app.config['RETRY_AFTER'] = 2  # segundos sugeridos al cliente tras un 503
+# Métricas en /metrics; cada worker vuelca las suyas en .metrics/ cada pocos segundos
+app.config['METRICS_FOLDER'] = os.path.join(UPLOAD_FOLDER, '.metrics')
+app.config['METRICS_FLUSH_INTERVAL'] = 5
+# Reenvío desde el servidor al procesador externo (opcional). Con RELAY_URL
+# definido cada archivo guardado se encola en .relay/ y un pool de hilos lo envía
+app.config['RELAY_URL'] = os.environ.get('RELAY_URL', '')
+app.config['RELAY_FOLDER'] = os.path.join(UPLOAD_FOLDER, '.relay')
+app.config['RELAY_WORKERS'] = 4
+app.config['RELAY_MAX_ATTEMPTS'] = 5
+app.config['RELAY_BACKOFF'] = 2  # segundos antes del primer reintento; se duplica en cada fallo
+# Destino de las subidas del navegador; una ruta relativa ('/upload') apunta a
+# este servidor. Con reenvío activo el navegador sube aquí y el servidor reenvía.
+app.config['CLIENT_UPLOAD_URL'] = os.environ.get('CLIENT_UPLOAD_URL') or (
+    '/upload' if app.config['RELAY_URL'] else 'https://salesforce-file-ica.onrender.com/upload_pdf')
+# Subidas simultáneas del navegador: la ventana empieza en CLIENT_CONCURRENCY y
+# se adapta entre el mínimo y el máximo según el rendimiento medido
+app.config['CLIENT_MIN_CONCURRENCY'] = int(os.environ.get('CLIENT_MIN_CONCURRENCY', 1))
+app.config['CLIENT_MAX_CONCURRENCY'] = int(os.environ.get('CLIENT_MAX_CONCURRENCY', 6))
+app.config['CLIENT_CONCURRENCY'] = int(os.environ.get('CLIENT_CONCURRENCY', 3))
+# Carpeta repartida en dos niveles de subcarpetas por hash del nombre (opcional).
+# Una carpeta existente se convierte con: flask --app app shard-migrate
+app.config['SHARDED_LAYOUT'] = os.environ.get('SHARDED_LAYOUT') == '1'
+app.config['INDEX_MAX_AGE'] = 300  # segundos de caché de la página principal
+# Detrás de Apache/lighttpd con mod_xsendfile el proxy envía el archivo con sendfile
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+# Cuota de disco y retención (opcionales). Un hilo borra lo más antiguo (o lo
+# menos descargado con RETENTION_POLICY=lru) al pasar de la cuota, y lo que
+# supera RETENTION_MAX_AGE. Sin espacio libre las subidas se rechazan con 507.
+app.config['STORAGE_QUOTA'] = int(os.environ.get('STORAGE_QUOTA', 0))  # bytes, 0 = sin cuota
+app.config['RETENTION_MAX_AGE'] = int(os.environ.get('RETENTION_MAX_AGE', 0))  # segundos, 0 = sin límite
+app.config['RETENTION_POLICY'] = os.environ.get('RETENTION_POLICY', 'age')  # 'age' o 'lru'
+app.config['JANITOR_INTERVAL'] = 30  # segundos entre pasadas
+app.config['DISK_RESERVE'] = 64 * 1024 * 1024  # espacio libre que se deja siempre en el disco
+# Almacenamiento comprimido (opcional): lo que llega por /upload se guarda en
+# gzip rápido mientras se recibe, salvo los formatos ya comprimidos. Las
+# descargas y /files siguen viendo el contenido y el tamaño originales.
+app.config['COMPRESSED_STORAGE'] = os.environ.get('COMPRESSED_STORAGE') == '1'
+app.config['COMPRESSION_LEVEL'] = 1
+# Catálogo SQLite de lo subido (opcional), consultable en /catalog.
+# Se reconstruye desde el disco con: flask --app app catalog-rebuild
+app.config['CATALOG_ENABLED'] = os.environ.get('CATALOG_ENABLED') == '1'
+app.config['CATALOG_PATH'] = os.path.join(UPLOAD_FOLDER, '.catalog.sqlite3')
+# Post-procesado en segundo plano (opcional): al publicar un archivo un pool de
+# procesos detecta su tipo real, cuenta las páginas de los PDF, verifica el
+# SHA-256 y lista el contenido de zip/tar. Los resultados quedan en .meta/ y el
+# avance se anuncia en /events (Server-Sent Events). PROCESSING_PLUGINS: módulos
+# separados por comas que registran pasos propios con @processing.step
+app.config['POST_PROCESSING'] = os.environ.get('POST_PROCESSING') == '1'
+app.config['PROCESSING_WORKERS'] = int(os.environ.get('PROCESSING_WORKERS', 2))
+app.config['PROCESSING_PLUGINS'] = [m.strip() for m in os.environ.get('PROCESSING_PLUGINS', '').split(',') if m.strip()]
+app.config['META_FOLDER'] = os.path.join(UPLOAD_FOLDER, '.meta')
+app.config['EVENTS_MAX_DURATION'] = 60  # segundos por conexión a /events; el navegador reconecta solo
+# Con WSGI cada conexión a /events ocupa un hilo: como mucho estas por proceso.
+# asgi.py las sirve sin hilos y marca ASYNC_EVENTS; sólo entonces las usa la página
+app.config['EVENTS_MAX_STREAMS'] = int(os.environ.get('EVENTS_MAX_STREAMS', 4))
+app.config['ASYNC_EVENTS'] = False
+
+# Registro de cambios para ETag y /files?since=<cursor>. También guarda la
+# fecha de publicación de cada nombre, que el disco no conoce en los enlaces a blobs
+JOURNAL_MAX_BYTES = 16 * 1024 * 1024  # se compacta al arrancar o desde el limpiador si lo supera
+change_log = ChangeLog(os.path.join(UPLOAD_FOLDER, '.journal'), JOURNAL_MAX_BYTES)
+
+# Índice en memoria de /files, reconstruido al arrancar
+file_index = FileIndex()
+file_index.rebuild(UPLOAD_FOLDER, app.config['SHARDED_LAYOUT'], change_log.published())
+
+change_log.open(file_index.publish_entries())
+file_index.cursor = file_index.version = change_log.cursor()
+
+upload_admission = UploadAdmission(
+    app.config['MAX_INFLIGHT_UPLOADS'],
+    app.config['MAX_INFLIGHT_BYTES'],
+    app.config['UPLOAD_RATE_LIMIT']
+)
+
+metrics = Metrics(
+    app.config['METRICS_FOLDER'],
+    6 * app.config['METRICS_FLUSH_INTERVAL'],
+    lambda: {'uploads_in_flight': upload_admission.uploads,
+             'upload_in_flight_bytes': upload_admission.bytes}
+)
+
+catalog = Catalog(app.config['CATALOG_PATH']) if app.config['CATALOG_ENABLED'] else None
+
+# Siempre activo: aunque no haya cuota ni retención caducan las sesiones reanudables
+janitor = Janitor(
+    app.config['STORAGE_QUOTA'],
+    app.config['RETENTION_MAX_AGE'],
+    app.config['RETENTION_POLICY'],
+    app.config['JANITOR_INTERVAL'],
+    os.path.join(UPLOAD_FOLDER, '.janitor.lock')
+)
+
+# Registro de eventos del post-procesado, compartido por todos los workers
+EVENTS_MAX_BYTES = 8 * 1024 * 1024  # se compacta al arrancar o desde el limpiador si lo supera
+event_log = None
+post_processor = None
+if app.config['POST_PROCESSING']:
+    event_log = ChangeLog(os.path.join(UPLOAD_FOLDER, '.events'), EVENTS_MAX_BYTES)
+    event_log.open()
+    post_processor = PostProcessor(
+        app.config['META_FOLDER'],
+        app.config['PROCESSING_WORKERS'],
+        app.config['PROCESSING_PLUGINS'],
+        event_log
+    )
+
+relay_queue = None
+if app.config['RELAY_URL']:
+    relay_queue = RelayQueue(
+        app.config['RELAY_FOLDER'],
+        app.config['RELAY_URL'],
+        app.config['RELAY_WORKERS'],
+        app.config['RELAY_MAX_ATTEMPTS'],
+        app.config['RELAY_BACKOFF']
+    )
 
 # HTML Template con subida múltiple
 HTML_TEMPLATE = """
@@ -110,12 +1580,20 @@ HTML_TEMPLATE = """
         }
         
         .files-list {
+            position: relative;
             margin-bottom: 20px;
             max-height: 400px;
-            overflow-y: none;
+            overflow-y: auto;
         }
         
+        /* Lista virtual: sólo existen en el DOM las filas visibles, cada una
+           posicionada por su índice; el espaciador da la altura total */
         .file-item {
+            position: absolute;
+            left: 0;
+            right: 0;
+            height: 74px;
+            box-sizing: border-box;
             display: flex;
             align-items: center;
             justify-content: space-between;
@@ -142,7 +1620,7 @@ HTML_TEMPLATE = """
             border-color: #4caf50;
         }
         
-        .file-item.error {
+        .file-item.error, .file-item.too-large {
             background: #ffebee;
             border-color: #f44336;
         }
@@ -160,18 +1638,24 @@ HTML_TEMPLATE = """
         
         .file-details {
             flex: 1;
+            min-width: 0;
         }
         
         .file-name {
             font-weight: bold;
             color: #333;
             margin-bottom: 5px;
-            word-break: break-all;
+            white-space: nowrap;
+            overflow: hidden;
+            text-overflow: ellipsis;
         }
         
         .file-size {
             color: #666;
             font-size: 13px;
+            white-space: nowrap;
+            overflow: hidden;
+            text-overflow: ellipsis;
         }
         
         .file-status {
@@ -196,11 +1680,16 @@ HTML_TEMPLATE = """
             color: #2e7d32;
         }
         
-        .status-error {
+        .status-error, .status-too-large {
             background: #ffebee;
             color: #c62828;
         }
         
+        .status-hashing {
+            background: #ede7f6;
+            color: #5e35b1;
+        }
+        
         .remove-btn {
             background: #ff5252;
             color: white;
@@ -342,7 +1831,7 @@ HTML_TEMPLATE = """
             <div class="upload-text">
                 <strong>Selecciona múltiples archivos</strong>
                 <p>Puedes arrastrar y soltar archivos aquí</p>
-                <p style="font-size: 12px; margin-top: 5px; color: #999;">Máximo 50 MB por archivo</p>
+                <p style="font-size: 12px; margin-top: 5px; color: #999;">Máximo {{ max_file_label }} por archivo</p>
             </div>
             <input type="file" id="fileInput" multiple>
         </div>
@@ -393,8 +1882,21 @@ HTML_TEMPLATE = """
         const fileCount = document.getElementById('fileCount');
         const progressFill = document.getElementById('progressFill');
         
+        const MAX_FILE_SIZE = {{ max_file_size|tojson }};
         var removeFileBtn = true;
         let selectedFiles = [];
+        // Índice por nombre y tamaño para descartar duplicados sin recorrer la lista
+        let fileKeys = new Map();
+        // Totales mantenidos al añadir, quitar o cambiar de estado un archivo
+        let totalBytes = 0;
+        let statusCounts = {};
+        
+        const ROW_HEIGHT = 84;  // alto de .file-item más su margen
+        const OVERSCAN = 5;  // filas extra por encima y por debajo de lo visible
+        const renderedRows = new Map();  // índice -> fila en el DOM
+        let renderPending = false;
+        const filesSpacer = document.createElement('div');
+        filesList.appendChild(filesSpacer);
         
         uploadArea.addEventListener('click', () => fileInput.click());
         
@@ -417,53 +1919,131 @@ HTML_TEMPLATE = """
             handleFiles(Array.from(e.dataTransfer.files));
         });
         
+        filesList.addEventListener('scroll', updateUI);
+        
+        filesList.addEventListener('click', (e) => {
+            const button = e.target.closest('.remove-btn');
+            if (button) {
+                removeFile(Number(button.closest('.file-item').dataset.index));
+            }
+        });
+        
+        function fileKey(file) {
+            return `${file.name}/${file.size}`;
+        }
+        
         function handleFiles(files) {
             files.forEach(file => {
-                if (!selectedFiles.find(f => f.name === file.name && f.size === file.size)) {
-                    selectedFiles.push({
-                        file: file,
-                        id: Date.now() + Math.random(),
-                        status: 'pending'
-                    });
-                }
+                const key = fileKey(file);
+                if (fileKeys.has(key)) return;
+                
+                const fileObj = {
+                    file: file,
+                    id: Date.now() + Math.random(),
+                    version: 0,  // sube con cada cambio que haya que pintar
+                    // Lo que el servidor rechazaría no llega a enviarse
+                    status: file.size > MAX_FILE_SIZE ? 'too-large' : 'pending'
+                };
+                fileKeys.set(key, fileObj);
+                selectedFiles.push(fileObj);
+                totalBytes += file.size;
+                statusCounts[fileObj.status] = (statusCounts[fileObj.status] || 0) + 1;
             });
             updateUI();
         }
         
+        function setStatus(fileObj, status) {
+            statusCounts[fileObj.status]--;
+            fileObj.status = status;
+            fileObj.version++;
+            statusCounts[status] = (statusCounts[status] || 0) + 1;
+            updateUI();
+        }
+        
+        // Los cambios se agrupan y se pintan una vez por frame
         function updateUI() {
-            removeFileBtn = true;
-            filesList.innerHTML = '';
+            if (renderPending) return;
+            renderPending = true;
+            requestAnimationFrame(() => {
+                renderPending = false;
+                renderRows();
+                updateSummary();
+            });
+        }
+        
+        // Pinta sólo las filas visibles y rellena sólo las que cambiaron
+        function renderRows() {
+            filesSpacer.style.height = `${selectedFiles.length * ROW_HEIGHT}px`;
+            const first = Math.max(0, Math.floor(filesList.scrollTop / ROW_HEIGHT) - OVERSCAN);
+            const last = Math.min(selectedFiles.length,
+                Math.ceil((filesList.scrollTop + filesList.clientHeight) / ROW_HEIGHT) + OVERSCAN);
             
-            selectedFiles.forEach((fileObj, index) => {
-                const fileItem = document.createElement('div');
-                fileItem.className = `file-item ${fileObj.status}`;
-                fileItem.innerHTML = `
-                    <div class="file-info">
-                        <div class="file-icon">${getFileIcon(fileObj.file.name)}</div>
-                        <div class="file-details">
-                            <div class="file-name">${fileObj.file.name}</div>
-                            <div class="file-size">${formatFileSize(fileObj.file.size)}</div>
-                        </div>
-                        <span class="file-status status-${fileObj.status}">
-                            ${getStatusText(fileObj.status)}
-                        </span>
-                    </div>
-                    <button class="remove-btn" onclick="removeFile(${index})" 
-                            ${fileObj.status === 'uploading' ? 'disabled' : ''}>
-                        ✕
-                    </button>
-                `;
-                filesList.appendChild(fileItem);
+            renderedRows.forEach((row, index) => {
+                if (index < first || index >= last) {
+                    row.remove();
+                    renderedRows.delete(index);
+                }
             });
             
-            const totalSizeBytes = selectedFiles.reduce((sum, f) => sum + f.file.size, 0);
-            totalFiles.textContent = selectedFiles.length;
-            totalSize.textContent = formatFileSize(totalSizeBytes);
-            fileCount.textContent = selectedFiles.length;
+            for (let index = first; index < last; index++) {
+                const fileObj = selectedFiles[index];
+                let row = renderedRows.get(index);
+                if (!row) {
+                    row = createRow();
+                    row.dataset.index = index;
+                    row.style.top = `${index * ROW_HEIGHT}px`;
+                    filesList.appendChild(row);
+                    renderedRows.set(index, row);
+                }
+                if (row.fileObj !== fileObj || row.version !== fileObj.version) {
+                    fillRow(row, fileObj);
+                }
+            }
+        }
+        
+        function createRow() {
+            const row = document.createElement('div');
+            row.innerHTML = `
+                <div class="file-info">
+                    <div class="file-icon"></div>
+                    <div class="file-details">
+                        <div class="file-name"></div>
+                        <div class="file-size"></div>
+                    </div>
+                    <span class="file-status"></span>
+                </div>
+                <button class="remove-btn">✕</button>
+            `;
+            return row;
+        }
+        
+        function fillRow(row, fileObj) {
+            row.fileObj = fileObj;
+            row.version = fileObj.version;
+            row.className = `file-item ${fileObj.status}`;
+            row.querySelector('.file-icon').textContent = getFileIcon(fileObj.file.name);
+            row.querySelector('.file-name').textContent = fileObj.file.name;
+            row.querySelector('.file-name').title = fileObj.file.name;
+            row.querySelector('.file-size').textContent = fileObj.processing
+                ? `${formatFileSize(fileObj.file.size)} · ${fileObj.processing}`
+                : formatFileSize(fileObj.file.size);
+            const status = row.querySelector('.file-status');
+            status.className = `file-status status-${fileObj.status}`;
+            status.textContent = getStatusText(fileObj.status);
+            row.querySelector('.remove-btn').disabled = fileObj.status === 'uploading';
+        }
+        
+        function updateSummary() {
+            const count = selectedFiles.length;
+            const busy = (statusCounts['uploading'] || 0) > 0;
+            totalFiles.textContent = count;
+            totalSize.textContent = formatFileSize(totalBytes);
+            fileCount.textContent = count;
             
-            uploadBtn.disabled = selectedFiles.length === 0 || selectedFiles.some(f => f.status === 'uploading');
-            clearBtn.disabled = selectedFiles.length === 0 || selectedFiles.some(f => f.status === 'uploading');
-            summary.classList.toggle('show', selectedFiles.length > 0);
+            // Terminada la subida (removeFileBtn en false) los botones quedan inhabilitados
+            uploadBtn.disabled = !removeFileBtn || count === 0 || busy;
+            clearBtn.disabled = !removeFileBtn || count === 0 || busy;
+            summary.classList.toggle('show', count > 0);
         }
         
         function getFileIcon(filename) {
@@ -487,9 +2067,11 @@ HTML_TEMPLATE = """
         function getStatusText(status) {
             const texts = {
                 'pending': '⏳ Pendiente',
+                'hashing': '🔎 Verificando...',
                 'uploading': '⬆️ Subiendo...',
                 'success': '✅ Completado',
-                'error': '❌ Error'
+                'error': '❌ Error',
+                'too-large': '❌ Supera el máximo'
             };
             return texts[status] || status;
         }
@@ -504,7 +2086,10 @@ HTML_TEMPLATE = """
         
         function removeFile(index) {
             if(removeFileBtn) {
-                selectedFiles.splice(index, 1);
+                const [fileObj] = selectedFiles.splice(index, 1);
+                fileKeys.delete(fileKey(fileObj.file));
+                totalBytes -= fileObj.file.size;
+                statusCounts[fileObj.status]--;
                 updateUI();
             } else {
                 return false;
@@ -513,57 +2098,278 @@ HTML_TEMPLATE = """
         
         clearBtn.addEventListener('click', () => {
             selectedFiles = [];
+            fileKeys = new Map();
+            totalBytes = 0;
+            statusCounts = {};
             fileInput.value = '';
             updateUI();
             progressFill.style.width = '0%';
             uploadStatus.textContent = 'Listo';
         });
         
-        uploadBtn.addEventListener('click', async () => {
-            let completed = 0;
-            const total = selectedFiles.length;
+        // Subidas concurrentes con una ventana adaptable: crece de uno en uno
+        // mientras el rendimiento medido mejora y se reduce a la mitad con errores
+        const UPLOAD_URL = {{ upload_url|tojson }};
+        const DEDUP_ENABLED = {{ dedup_enabled|tojson }};
+        const MIN_CONCURRENCY = {{ min_concurrency|tojson }};
+        const MAX_CONCURRENCY = {{ max_concurrency|tojson }};
+        let concurrency = {{ concurrency|tojson }};
+        const MAX_BUSY_RETRIES = 5;
+        let lastThroughput = 0;
+        let windowBytes = 0;
+        let windowDone = 0;
+        let windowStart = performance.now();
+        
+        function adaptConcurrency(ok, bytes) {
+            if (!ok) {
+                concurrency = Math.max(MIN_CONCURRENCY, Math.floor(concurrency / 2));
+                lastThroughput = 0;
+                windowBytes = 0;
+                windowDone = 0;
+                windowStart = performance.now();
+                return;
+            }
+            windowBytes += bytes;
+            windowDone++;
+            // Se mide el rendimiento cada vez que se completa una ventana entera
+            if (windowDone < concurrency) return;
+            const elapsed = (performance.now() - windowStart) / 1000;
+            const throughput = windowBytes / Math.max(elapsed, 0.001);
+            if (throughput >= lastThroughput * 1.05) {
+                concurrency = Math.min(MAX_CONCURRENCY, concurrency + 1);
+            } else if (throughput < lastThroughput * 0.9) {
+                concurrency = Math.max(MIN_CONCURRENCY, concurrency - 1);
+            }
+            lastThroughput = throughput;
+            windowBytes = 0;
+            windowDone = 0;
+            windowStart = performance.now();
+        }
+        
+        // SHA-256 de cada archivo calculado en un Web Worker para no bloquear la página
+        const HASH_WORKER_SRC = `
+            self.onmessage = async (e) => {
+                const { id, file } = e.data;
+                try {
+                    const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+                    const hex = Array.from(new Uint8Array(digest))
+                        .map(b => b.toString(16).padStart(2, '0')).join('');
+                    self.postMessage({ id, hex });
+                } catch (error) {
+                    self.postMessage({ id, hex: null });
+                }
+            };
+        `;
+        let hashWorker = null;
+        const pendingHashes = new Map();
+        
+        function hashFile(fileObj) {
+            if (!window.Worker || !window.crypto || !window.crypto.subtle) {
+                return Promise.resolve(null);
+            }
+            if (!hashWorker) {
+                const blob = new Blob([HASH_WORKER_SRC], { type: 'text/javascript' });
+                hashWorker = new Worker(URL.createObjectURL(blob));
+                hashWorker.onmessage = (e) => {
+                    pendingHashes.get(e.data.id)(e.data.hex);
+                    pendingHashes.delete(e.data.id);
+                };
+            }
+            return new Promise(resolve => {
+                pendingHashes.set(fileObj.id, resolve);
+                hashWorker.postMessage({ id: fileObj.id, file: fileObj.file });
+            });
+        }
+        
+        // Si el servidor ya tiene esos bytes basta con registrar el nombre
+        async function linkExisting(fileObj) {
+            setStatus(fileObj, 'hashing');
+            fileObj.sha256 = await hashFile(fileObj);
+            setStatus(fileObj, 'uploading');
+            if (!fileObj.sha256) return false;
             
-            uploadStatus.textContent = '⬆️ Subiendo...';
-            uploadStatus.classList.add('uploading-animation');
+            try {
+                const response = await fetch(`/blobs/${fileObj.sha256}`, {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ filename: fileObj.file.name })
+                });
+                if (response.status != 200) return false;
+                trackProcessing(fileObj, await response.json());
+                return true;
+            } catch (error) {
+                return false;
+            }
+        }
+        
+        // Devuelve si la subida terminó bien y cuántos bytes viajaron por la red
+        async function uploadOne(fileObj) {
+            if (DEDUP_ENABLED && await linkExisting(fileObj)) {
+                return { ok: true, bytes: 0 };
+            }
             
-            for (let i = 0; i < selectedFiles.length; i++) {
-                if (selectedFiles[i].status === 'success') {
-                    completed++;
-                    continue;
-                }
-                
-                selectedFiles[i].status = 'uploading';
-                updateUI();
-                
-                const formData = new FormData();
-                formData.append('file', selectedFiles[i].file);
-                
-                try {
-                    const response = await fetch('https://salesforce-file-ica.onrender.com/upload_pdf', {
+            const formData = new FormData();
+            formData.append('file', fileObj.file);
+            
+            try {
+                for (let attempt = 0; ; attempt++) {
+                    const response = await fetch(UPLOAD_URL, {
                         method: 'POST',
                         body: formData
                     });
+                    // Servidor saturado: esperar lo que pide Retry-After y reintentar
+                    if ((response.status == 503 || response.status == 429) && attempt < MAX_BUSY_RETRIES) {
+                        adaptConcurrency(false, 0);
+                        const wait = parseFloat(response.headers.get('Retry-After')) || 2;
+                        await new Promise(r => setTimeout(r, wait * 1000));
+                        continue;
+                    }
                     if (response.status == 200) {
-                        selectedFiles[i].status = 'success';
-                        completed++;
-                    } else {
-                        selectedFiles[i].status = 'error';
+                        trackProcessing(fileObj, await response.json().catch(() => ({})));
                     }
-                } catch (error) {
-                    selectedFiles[i].status = 'error';
+                    return { ok: response.status == 200, bytes: fileObj.file.size };
+                }
+            } catch (error) {
+                return { ok: false, bytes: 0 };
+            }
+        }
+        
+        // Post-procesado en el servidor: su avance llega por /events
+        const PROCESSING_ENABLED = {{ processing_enabled|tojson }};
+        const serverNames = new Map();  // nombre guardado -> fileObj
+        const processingState = new Map();  // nombre guardado -> texto, llegue antes o después de la respuesta
+        let processingLeft = 0;
+        let uploadsFinished = false;
+        let events = null;
+        
+        // Se espera a que la conexión esté abierta para no perder eventos de las primeras subidas
+        function openEvents() {
+            if (!PROCESSING_ENABLED || events) return Promise.resolve();
+            return new Promise(resolve => {
+                events = new EventSource('/events');
+                events.addEventListener('open', resolve, { once: true });
+                events.addEventListener('error', resolve, { once: true });
+                events.addEventListener('progress', e => {
+                    const data = JSON.parse(e.data);
+                    showProcessing(data.name, `⚙️ Procesando ${data.completed}/${data.total}`, false);
+                });
+                events.addEventListener('done', e => {
+                    const data = JSON.parse(e.data);
+                    showProcessing(data.name, describeProcessing(data.summary), true);
+                });
+                // Se perdieron eventos: se piden los resultados de lo que falta
+                events.addEventListener('reset', () => {
+                    serverNames.forEach((fileObj, name) => {
+                        if (!fileObj.processed) refreshProcessing(name);
+                    });
+                });
+            });
+        }
+        
+        function trackProcessing(fileObj, result) {
+            if (!events || !result.filename) return;
+            serverNames.set(result.filename, fileObj);
+            processingLeft++;
+            const state = processingState.get(result.filename);
+            if (state) showProcessing(result.filename, state.text, state.done);
+        }
+        
+        function showProcessing(name, text, done) {
+            processingState.set(name, { text, done });
+            const fileObj = serverNames.get(name);
+            if (!fileObj || fileObj.processed) return;
+            fileObj.processing = text;
+            fileObj.version++;
+            if (done) {
+                fileObj.processed = true;
+                processingLeft--;
+                closeEventsIfIdle();
+            }
+            updateUI();
+        }
+        
+        async function refreshProcessing(name) {
+            try {
+                const response = await fetch(`/files/${encodeURIComponent(name)}/meta`);
+                if (response.status != 200) return;
+                const meta = await response.json();
+                if (meta.complete) showProcessing(name, '✔️ Procesado', true);
+            } catch (error) {}
+        }
+        
+        function closeEventsIfIdle() {
+            if (events && uploadsFinished && processingLeft === 0) {
+                events.close();
+                events = null;
+            }
+        }
+        
+        function describeProcessing(summary) {
+            const parts = [];
+            if (summary.pages != null) parts.push(`${summary.pages} págs.`);
+            if (summary.entries != null) parts.push(`${summary.entries} archivos dentro`);
+            if (summary.mime_matches === false) parts.push(`⚠️ parece ${summary.mime}`);
+            if (summary.verified === false) parts.push('⚠️ el contenido no coincide');
+            else if (summary.verified) parts.push('✔️ verificado');
+            if (summary.errors && summary.errors.length) parts.push(`⚠️ falló: ${summary.errors.join(', ')}`);
+            return parts.join(' · ') || '✔️ Procesado';
+        }
+        
+        function runUploadQueue(queue, onDone) {
+            return new Promise(resolve => {
+                let active = 0;
+                
+                function pump() {
+                    if (queue.length === 0 && active === 0) {
+                        resolve();
+                        return;
+                    }
+                    while (active < concurrency && queue.length > 0) {
+                        const fileObj = queue.shift();
+                        active++;
+                        setStatus(fileObj, 'uploading');
+                        uploadOne(fileObj).then(({ ok, bytes }) => {
+                            active--;
+                            adaptConcurrency(ok, bytes);
+                            onDone(fileObj, ok);
+                            pump();
+                        });
+                    }
+                }
+                pump();
+            });
+        }
+        
+        uploadBtn.addEventListener('click', async () => {
+            let completed = statusCounts['success'] || 0;
+            const total = selectedFiles.length;
+            const queue = selectedFiles.filter(f => f.status !== 'success' && f.status !== 'too-large');
+            
+            uploadStatus.textContent = '⬆️ Subiendo...';
+            uploadStatus.classList.add('uploading-animation');
+            uploadsFinished = false;
+            await openEvents();
+            
+            await runUploadQueue(queue, (fileObj, ok) => {
+                if (ok) {
+                    setStatus(fileObj, 'success');
+                    completed++;
+                } else {
+                    setStatus(fileObj, 'error');
                 }
                 
-                updateUI();
                 progressFill.style.width = `${(completed / total) * 100}%`;
-            }
+            });
             
             uploadStatus.classList.remove('uploading-animation');
+            uploadsFinished = true;
+            closeEventsIfIdle();
             uploadBtn.disabled = true;
             clearBtn.disabled = true;
             document.getElementById("uploadArea").style.display = "none";
             removeFileBtn = false  // Se inhabilita la opcion de borrar archivos despues de procesar todo
             
-            const hasErrors = selectedFiles.some(f => f.status === 'error');
+            const hasErrors = (statusCounts['error'] || 0) + (statusCounts['too-large'] || 0) > 0;
             if (hasErrors) {
                 uploadStatus.textContent = '⚠️ Con errores';
             } else {
@@ -575,10 +2381,248 @@ HTML_TEMPLATE = """
 </html>
 """
 
+def file_path(filename):
+    """Ruta en disco de un nombre visible, según la organización de la carpeta"""
+    folder = app.config['UPLOAD_FOLDER']
+    if app.config['SHARDED_LAYOUT']:
+        folder = shard_dir(folder, filename)
+    return os.path.join(folder, filename)
+
+def stored_path(name):
+    """(ruta en disco, comprimido) de un nombre visible; FileNotFoundError si no existe"""
+    filepath = file_path(name)
+    if os.path.exists(filepath):
+        return filepath, False
+    if os.path.exists(filepath + COMPRESSED_SUFFIX):
+        return filepath + COMPRESSED_SUFFIX, True
+    raise FileNotFoundError(filepath)
+
+def open_logical(name):
+    """Abrir el contenido original de un archivo (descomprimiendo si hace
+    falta); devuelve (archivo, tamaño)"""
+    filepath, compressed = stored_path(name)
+    if compressed:
+        return gzip.open(filepath, 'rb'), gzip_size(filepath)
+    return open(filepath, 'rb'), os.path.getsize(filepath)
+
+def new_ingest_file(filename, drain=False):
+    """IngestFile para una parte de archivo, comprimida si procede por su extensión"""
+    compress = app.config['COMPRESSED_STORAGE'] and file_extension(filename or '') not in STORED_EXTENSIONS
+    return IngestFile(app.config['INCOMING_FOLDER'], app.config['MAX_FILE_SIZE'],
+                      compress, app.config['COMPRESSION_LEVEL'], drain)
+
+def claim_filename(source, filename, compressed=False):
+    """Publica `source` como `filename` o, si ya existe, con un nombre único.
+    
+    os.link falla si el destino existe, así que reclamar el nombre y hacer
+    visible el archivo completo es una sola operación atómica: dos subidas
+    simultáneas del mismo nombre no se pisan y nadie ve un archivo a medias.
+    Un nombre puede estar en disco con o sin ~gz: tras enlazar se comprueba
+    que la otra variante no exista y, si existe, se prueba otro nombre.
+    Devuelve (nombre, ruta); `source` sigue existiendo.
+    """
+    base, extension = os.path.splitext(filename)
+    while True:
+        filepath = file_path(filename)
+        if app.config['SHARDED_LAYOUT']:
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        try:
+            os.link(source, stored_name(filepath, compressed))
+            if not os.path.exists(stored_name(filepath, not compressed)):
+                return filename, stored_name(filepath, compressed)
+            os.remove(stored_name(filepath, compressed))
+        except FileExistsError:
+            pass
+        # Si el archivo existe, agregar timestamp y un id único
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        filename = f"{base}_{timestamp}_{uuid.uuid4().hex[:8]}{extension}"
+
+def register_file(filename, filepath, digest=None, content_type=None, original_name=None):
+    """Anotar en el índice y en el registro de cambios un archivo recién publicado"""
+    stat = os.stat(filepath)
+    # La fecha es la de esta publicación: con el almacén por contenido el
+    # nombre es un enlace al blob y el inodo conserva la de la primera subida
+    published = time.time()
+    stored_size = None
+    size = stat.st_size
+    if filepath.endswith(COMPRESSED_SUFFIX):
+        stored_size, size = size, gzip_size(filepath)
+    if catalog is not None:
+        # Si el catálogo no acepta la fila la subida falla entera: no quedan
+        # archivos publicados que el catálogo no conozca
+        try:
+            catalog.add(filename, size, published, digest,
+                        content_type or mimetypes.guess_type(filename)[0], original_name)
+        except Exception:
+            os.remove(filepath)
+            raise
+    file_index.add(filename, size, published, stored_size)
+    entry = {'op': 'add', 'name': filename, 'size': size, 'modified': published}
+    if stored_size is not None:
+        entry['stored_size'] = stored_size
+    change_log.append(entry)
+    if relay_queue is not None:
+        relay_queue.enqueue(filename)
+    if post_processor is not None:
+        post_processor.submit(filename, filepath, size, published, digest)
+
+def delete_file(name):
+    """Borrar un archivo publicado y anotarlo en el índice, el registro de
+    cambios y el catálogo. Devuelve los bytes que ocupaba según el índice."""
+    stored_size = file_index.stored_size(name)
+    try:
+        filepath, compressed = stored_path(name)
+        # Con el almacén por contenido, si sólo quedaban este nombre y el blob,
+        # el blob sobra también (el contenido se lee para saber cuál es)
+        orphan_blob = None
+        if app.config['CAS_ENABLED'] and os.stat(filepath).st_nlink == 2:
+            orphan_blob = blob_path(file_sha256(filepath, compressed), compressed)
+        os.remove(filepath)
+        if orphan_blob is not None and os.stat(orphan_blob).st_nlink == 1:
+            os.remove(orphan_blob)
+    except FileNotFoundError:
+        pass
+    file_index.remove(name)
+    change_log.append({'op': 'del', 'name': name})
+    if catalog is not None:
+        catalog.remove(name)
+    if post_processor is not None:
+        post_processor.discard(name)
+    return stored_size or 0
+
+def blob_path(digest, compressed=False):
+    """Ruta del blob con ese SHA-256 en el almacén por contenido"""
+    return stored_name(os.path.join(app.config['BLOB_FOLDER'], digest[:2], digest[2:4], digest), compressed)
+
+def existing_blob(digest):
+    """(ruta, comprimido) del blob con ese contenido, o None si no existe"""
+    for compressed in (False, True):
+        blob = blob_path(digest, compressed)
+        if os.path.exists(blob):
+            return blob, compressed
+    return None
+
+def file_sha256(filepath, compressed=False):
+    sha256 = hashlib.sha256()
+    with (gzip.open(filepath, 'rb') if compressed else open(filepath, 'rb')) as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def publish_file(source, filename, digest, content_type=None, original_name=None, compressed=False):
+    """Publica el archivo temporal `source` bajo un nombre libre.
+    
+    Con el almacén por contenido activo el nombre es un enlace duro al blob,
+    y si el blob ya existía el temporal se descarta sin escribir otra copia.
+    `compressed` indica que `source` está en gzip. Devuelve (nombre, ruta, deduplicado).
+    """
+    if not app.config['CAS_ENABLED']:
+        filename, filepath = claim_filename(source, filename, compressed)
+        os.remove(source)
+        register_file(filename, filepath, digest, content_type, original_name)
+        return filename, filepath, False
+    
+    # El blob también se crea con os.link: si otra subida con el mismo
+    # contenido llegó antes, el enlace falla y este temporal sobra. El
+    # temporal se conserva hasta reclamar el nombre: si el limpiador borra
+    # el blob huérfano entre medias, se vuelve a crear desde él
+    blob = blob_path(digest, compressed)
+    try:
+        while True:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            try:
+                os.link(source, blob)
+                deduplicated = False
+            except FileExistsError:
+                deduplicated = True
+            try:
+                filename, filepath = claim_filename(blob, filename, compressed)
+                break
+            except FileNotFoundError:
+                continue
+    finally:
+        os.remove(source)
+    
+    register_file(filename, filepath, digest, content_type, original_name)
+    return filename, filepath, deduplicated
+
+def client_dedup_enabled():
+    """El navegador sólo consulta /blobs si sube a este mismo servidor"""
+    return app.config['CAS_ENABLED'] and app.config['CLIENT_UPLOAD_URL'].startswith('/')
+
+def client_processing_enabled():
+    """La página sigue el post-procesado por /events si sube a este mismo
+    servidor y éste es el asíncrono (con WSGI cada pestaña ocuparía un hilo)"""
+    return (post_processor is not None and app.config['ASYNC_EVENTS']
+            and app.config['CLIENT_UPLOAD_URL'].startswith('/'))
+
+def save_upload(file):
+    """Publica una parte ya recibida y devuelve su descripción"""
+    
+    # El cuerpo ya se escribió en la carpeta de uploads mientras llegaba:
+    # sólo queda renombrarlo, sin copiar ni volver a leer el archivo
+    digest = file.stream.sha256.hexdigest()
+    filename, filepath, deduplicated = publish_file(
+        file.stream.detach(), secure_filename(file.filename), digest,
+        file.mimetype or None, file.filename, file.stream.compressed)
+    
+    return {
+        'filename': filename,
+        'size': file.stream.size,
+        'sha256': digest,
+        'deduplicated': deduplicated,
+        'path': filepath
+    }
+
+@functools.lru_cache(maxsize=1)
+def index_page():
+    """Renderiza la página una sola vez y prepara sus variantes comprimidas.
+    
+    Devuelve {codificación: (cuerpo, etag)}, en orden de preferencia.
+    """
+    min_concurrency = max(1, app.config['CLIENT_MIN_CONCURRENCY'])
+    max_concurrency = max(min_concurrency, app.config['CLIENT_MAX_CONCURRENCY'])
+    html = render_template_string(
+        HTML_TEMPLATE,
+        upload_url=app.config['CLIENT_UPLOAD_URL'],
+        min_concurrency=min_concurrency,
+        max_concurrency=max_concurrency,
+        concurrency=min(max(app.config['CLIENT_CONCURRENCY'], min_concurrency), max_concurrency),
+        dedup_enabled=client_dedup_enabled(),
+        processing_enabled=client_processing_enabled(),
+        max_file_size=app.config['MAX_FILE_SIZE'],
+        max_file_label=size_label(app.config['MAX_FILE_SIZE'])
+    ).encode('utf-8')
+    
+    bodies = {}
+    if brotli is not None:
+        bodies['br'] = brotli.compress(html, quality=11)
+    bodies['gzip'] = gzip.compress(html, compresslevel=9, mtime=0)
+    bodies['identity'] = html
+    
+    # ETag fuerte distinto por variante, como exige una codificación distinta
+    digest = hashlib.sha256(html).hexdigest()[:32]
+    return {encoding: (body, f'{digest}-{encoding}') for encoding, body in bodies.items()}
+
 @app.route('/')
 def index():
     """Servir la página HTML principal"""
-    return render_template_string(HTML_TEMPLATE)
+    page = index_page()
+    encoding = 'identity'
+    if 'Accept-Encoding' in request.headers:
+        encoding = request.accept_encodings.best_match(list(page)) or 'identity'
+    body, etag = page[encoding]
+    
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(body, mimetype='text/html')
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f"public, max-age={app.config['INDEX_MAX_AGE']}"
+    response.vary.add('Accept-Encoding')
+    return response
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
@@ -593,60 +2637,1123 @@ def upload_file():
         return jsonify({'error': 'No se seleccionó ningún archivo'}), 400
     
     try:
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        
-        # Si el archivo existe, agregar timestamp
-        base, extension = os.path.splitext(filename)
-        counter = 1
-        while os.path.exists(filepath):
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            filename = f"{base}_{timestamp}_{counter}{extension}"
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            counter += 1
-        
-        file.save(filepath)
-        file_size = os.path.getsize(filepath)
-        
-        return jsonify({
+        return jsonify({'message': 'Archivo subido exitosamente', **save_upload(file)}), 200
+        
+    except Exception as e:
+        return jsonify({'error': f'Error al guardar el archivo: {str(e)}'}), 500
+
+@app.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    """Endpoint para subir varios archivos en una sola petición"""
+    
+    # Se aceptan todas las partes de archivo, sin importar el nombre del campo
+    parts = list(request.files.items(multi=True))
+    if not parts:
+        return jsonify({'error': 'No se encontró ningún archivo'}), 400
+    
+    results = []
+    for field, file in parts:
+        if file.filename == '':
+            results.append({'success': False, 'original': '',
+                            'error': 'No se seleccionó ningún archivo'})
+            continue
+        if file.stream.too_large:
+            results.append({'success': False, 'original': file.filename,
+                            'error': too_large_message()})
+            continue
+        try:
+            results.append({'success': True, 'original': file.filename, **save_upload(file)})
+        except Exception as e:
+            results.append({'success': False, 'original': file.filename,
+                            'error': f'Error al guardar el archivo: {str(e)}'})
+    
+    succeeded = sum(1 for r in results if r['success'])
+    return jsonify({
+        'results': results,
+        'total': len(results),
+        'succeeded': succeeded,
+        'failed': len(results) - succeeded
+    }), 200
+
+DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+
+@app.route('/blobs/<digest>', methods=['GET', 'HEAD'])
+def lookup_blob(digest):
+    """Consultar si el servidor ya tiene un contenido por su SHA-256"""
+    if not app.config['CAS_ENABLED'] or not DIGEST_RE.match(digest):
+        return jsonify({'error': 'Contenido no encontrado'}), 404
+    found = existing_blob(digest)
+    if found is None:
+        return jsonify({'error': 'Contenido no encontrado'}), 404
+    blob, compressed = found
+    return jsonify({'sha256': digest, 'size': gzip_size(blob) if compressed else os.path.getsize(blob)}), 200
+
+@app.route('/blobs/<digest>', methods=['POST'])
+def link_blob(digest):
+    """Registrar un nombre para un contenido existente sin volver a subirlo"""
+    if not app.config['CAS_ENABLED'] or not DIGEST_RE.match(digest):
+        return jsonify({'error': 'Contenido no encontrado'}), 404
+    
+    data = request.get_json(silent=True) or {}
+    original_name = str(data.get('filename', ''))
+    filename = secure_filename(original_name)
+    if filename == '':
+        return jsonify({'error': 'No se indicó el nombre del archivo'}), 400
+    
+    found = existing_blob(digest)
+    if found is None:
+        return jsonify({'error': 'Contenido no encontrado'}), 404
+    blob, compressed = found
+    try:
+        filename, filepath = claim_filename(blob, filename, compressed)
+        register_file(filename, filepath, digest, original_name=original_name)
+    except FileNotFoundError:
+        return jsonify({'error': 'Contenido no encontrado'}), 404
+    except Exception as e:
+        return jsonify({'error': f'Error al guardar el archivo: {str(e)}'}), 500
+    
+    return jsonify({
+        'message': 'Archivo subido exitosamente',
+        'filename': filename,
+        'size': file_index.get(filename)[0],
+        'sha256': digest,
+        'deduplicated': True,
+        'path': filepath
+    }), 200
+
+# Subida reanudable (similar a tus): crear sesión, enviar bloques por offset,
+# consultar el offset confirmado y finalizar. Cada sesión vive en disco como
+# <id>.json (metadatos) y <id>.part (bytes recibidos), así que sobrevive a un
+# reinicio del servidor. El offset confirmado es el tamaño del .part. Una
+# sesión caduca RESUMABLE_TTL segundos después del último bloque recibido
+# (cabecera Upload-Expires) y el limpiador la borra.
+SESSION_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+def session_paths(session_id):
+    """Rutas (metadatos, datos) de una sesión o None si el id no es válido"""
+    if not SESSION_ID_RE.match(session_id):
+        return None
+    folder = app.config['RESUMABLE_FOLDER']
+    return (os.path.join(folder, f'{session_id}.json'),
+            os.path.join(folder, f'{session_id}.part'))
+
+def load_session(session_id):
+    """Carga una sesión de disco; devuelve (meta, ruta_datos) o (None, None)
+    si no existe o ya caducó"""
+    paths = session_paths(session_id)
+    if paths is None:
+        return None, None
+    try:
+        with open(paths[0], 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if session_expires(paths[1]) < time.time():
+            return None, None
+    except FileNotFoundError:
+        return None, None
+    return meta, paths[1]
+
+def session_expires(data_path):
+    """Instante en que caduca una sesión: cada bloque escrito la prolonga"""
+    return os.path.getmtime(data_path) + app.config['RESUMABLE_TTL']
+
+def lock_session(f):
+    """Bloqueo exclusivo del .part abierto en `f`; False si otra petición lo tiene"""
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
+def expire_sessions():
+    """Borrar las sesiones caducadas (y restos sin .json de más de RESUMABLE_TTL)"""
+    folder = app.config['RESUMABLE_FOLDER']
+    try:
+        names = os.listdir(folder)
+    except FileNotFoundError:
+        return
+    now = time.time()
+    for name in names:
+        session_id, _, extension = name.partition('.')
+        paths = session_paths(session_id)
+        if paths is None or extension != 'part':
+            # .json.tmp de una creación interrumpida o .json sin su .part
+            path = os.path.join(folder, name)
+            orphan = name.endswith('.tmp') or (paths is not None and not os.path.exists(paths[1]))
+            try:
+                if orphan and now - os.path.getmtime(path) > app.config['RESUMABLE_TTL']:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+            continue
+        meta_path, data_path = paths
+        try:
+            if session_expires(data_path) >= now:
+                continue
+            with open(data_path, 'rb') as f:
+                # Una escritura en curso tiene el bloqueo: la sesión sigue viva
+                if not lock_session(f):
+                    continue
+                for path in (meta_path, data_path):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+        except FileNotFoundError:
+            continue
+        app.logger.info('Sesión de subida %s caducada', session_id)
+
+def compact_logs():
+    """Compactar en marcha los registros que pasan de su tamaño máximo.
+    
+    Los cursores anteriores reciben 410 en /files?since= y un evento 'reset'
+    en /events; los demás workers releen la carpeta en su próximo sync_index.
+    """
+    if change_log.oversized():
+        change_log.compact(republished_entries)
+        app.logger.info('Registro de cambios compactado')
+    if event_log is not None and event_log.oversized():
+        event_log.compact()
+        app.logger.info('Registro de eventos compactado')
+
+def expire_incoming():
+    """Borrar de .incoming las partes abandonadas: Request.close() borra las
+    de cada petición, pero no se llama si el worker muere a mitad"""
+    folder = app.config['INCOMING_FOLDER']
+    try:
+        entries = list(os.scandir(folder))
+    except FileNotFoundError:
+        return
+    limit = time.time() - app.config['INCOMING_MAX_AGE']
+    for entry in entries:
+        if not entry.name.endswith('.part'):
+            continue
+        try:
+            if entry.stat().st_mtime < limit:
+                os.remove(entry.path)
+                app.logger.info('Parte abandonada %s borrada', entry.name)
+        except FileNotFoundError:
+            continue
+
+def session_response(session_id, meta, offset, status=200):
+    response = jsonify({
+        'id': session_id,
+        'filename': meta['filename'],
+        'size': meta['size'],
+        'offset': offset
+    })
+    response.status_code = status
+    response.headers['Upload-Offset'] = str(offset)
+    response.headers['Upload-Length'] = str(meta['size'])
+    response.headers['Upload-Expires'] = http_date(session_expires(session_paths(session_id)[1]))
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/upload/resumable', methods=['POST'])
+def create_upload_session():
+    """Crear una sesión de subida reanudable"""
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(str(data.get('filename', '')))
+    size = data.get('size')
+    
+    if filename == '':
+        return jsonify({'error': 'No se indicó el nombre del archivo'}), 400
+    if not isinstance(size, int) or size < 0:
+        return jsonify({'error': 'Tamaño de archivo no válido'}), 400
+    if size > app.config['RESUMABLE_MAX_SIZE']:
+        return jsonify({'error': 'Archivo demasiado grande para subida reanudable'}), 413
+    rejected = storage_rejection(size)
+    if rejected is not None:
+        payload, status, retry_after = rejected
+        response = jsonify(payload)
+        response.status_code = status
+        if retry_after is not None:
+            response.headers['Retry-After'] = str(retry_after)
+        return response
+    
+    os.makedirs(app.config['RESUMABLE_FOLDER'], exist_ok=True)
+    session_id = uuid.uuid4().hex
+    meta_path, data_path = session_paths(session_id)
+    meta = {'filename': filename, 'size': size, 'created': time.time()}
+    
+    open(data_path, 'wb').close()
+    # Escritura atómica de los metadatos: la sesión existe sólo cuando el .json está completo
+    with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(meta_path + '.tmp', meta_path)
+    
+    response = session_response(session_id, meta, 0, 201)
+    response.headers['Location'] = f'/upload/resumable/{session_id}'
+    return response
+
+@app.route('/upload/resumable/<session_id>', methods=['GET', 'HEAD'])
+def upload_session_status(session_id):
+    """Consultar el offset confirmado de una sesión"""
+    meta, data_path = load_session(session_id)
+    if meta is None:
+        return jsonify({'error': 'Sesión de subida no encontrada'}), 404
+    return session_response(session_id, meta, os.path.getsize(data_path))
+
+@app.route('/upload/resumable/<session_id>', methods=['PATCH', 'PUT'])
+def upload_session_chunk(session_id):
+    """Escribir un bloque de bytes en el offset indicado por Upload-Offset"""
+    meta, data_path = load_session(session_id)
+    if meta is None:
+        return jsonify({'error': 'Sesión de subida no encontrada'}), 404
+    
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+    except ValueError:
+        return jsonify({'error': 'Falta la cabecera Upload-Offset'}), 400
+    
+    length = request.content_length
+    if length is not None and offset + length > meta['size']:
+        return jsonify({'error': 'El bloque excede el tamaño declarado'}), 413
+    
+    with open(data_path, 'r+b') as f:
+        if not lock_session(f):
+            return jsonify({'error': 'Otra petición está escribiendo en esta sesión'}), 409
+        
+        current = os.fstat(f.fileno()).st_size
+        if offset != current:
+            return session_response(session_id, meta, current, 409)
+        
+        f.seek(offset)
+        remaining = meta['size'] - offset
+        start = time.perf_counter()
+        write_time = 0.0
+        try:
+            while remaining > 0:
+                chunk = request.stream.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                write_start = time.perf_counter()
+                f.write(chunk)
+                write_time += time.perf_counter() - write_start
+                remaining -= len(chunk)
+        finally:
+            record_ingest_time(meta['size'] - offset - remaining, time.perf_counter() - start, write_time)
+            # Lo escrito queda confirmado aunque el cliente se desconecte a mitad
+            f.flush()
+            os.fsync(f.fileno())
+            offset = os.fstat(f.fileno()).st_size
+    
+    response = session_response(session_id, meta, offset)
+    response.status_code = 204
+    return response
+
+@app.route('/upload/resumable/<session_id>/complete', methods=['POST'])
+def complete_upload_session(session_id):
+    """Finalizar una sesión: mover el archivo completo a la carpeta de uploads"""
+    meta, data_path = load_session(session_id)
+    if meta is None:
+        return jsonify({'error': 'Sesión de subida no encontrada'}), 404
+    
+    try:
+        f = open(data_path, 'rb')
+    except FileNotFoundError:
+        return jsonify({'error': 'Sesión de subida no encontrada'}), 404
+    # Con el mismo bloqueo que los bloques: ni se escribe ni se completa dos veces a la vez
+    with f:
+        if not lock_session(f):
+            return jsonify({'error': 'Otra petición está usando esta sesión'}), 409
+        # Otra petición pudo completarla mientras se abría el archivo
+        meta, data_path = load_session(session_id)
+        if meta is None:
+            return jsonify({'error': 'Sesión de subida no encontrada'}), 404
+        return publish_session(session_id, meta, data_path)
+
+def publish_session(session_id, meta, data_path):
+    """Publicar el .part completo de una sesión (con su bloqueo ya tomado)"""
+    offset = os.path.getsize(data_path)
+    if offset != meta['size']:
+        return session_response(session_id, meta, offset, 409)
+    
+    try:
+        digest = file_sha256(data_path) if app.config['CAS_ENABLED'] or catalog is not None else None
+        filename, filepath, deduplicated = publish_file(data_path, meta['filename'], digest)
+        os.remove(session_paths(session_id)[0])
+        
+        response = {
             'message': 'Archivo subido exitosamente',
             'filename': filename,
-            'size': file_size,
+            'size': meta['size'],
+            'deduplicated': deduplicated,
             'path': filepath
-        }), 200
+        }
+        if digest is not None:
+            response['sha256'] = digest
+        return jsonify(response), 200
         
     except Exception as e:
         return jsonify({'error': f'Error al guardar el archivo: {str(e)}'}), 500
 
+@app.route('/upload/resumable/<session_id>', methods=['DELETE'])
+def delete_upload_session(session_id):
+    """Cancelar una sesión y borrar los bytes recibidos"""
+    meta, data_path = load_session(session_id)
+    if meta is None:
+        return jsonify({'error': 'Sesión de subida no encontrada'}), 404
+    os.remove(session_paths(session_id)[0])
+    if os.path.exists(data_path):
+        os.remove(data_path)
+    return '', 204
+
+def sync_index():
+    """Aplicar al índice los cambios que anotaron otros procesos trabajadores"""
+    with file_index.sync_lock:
+        changes, cursor = change_log.changes(file_index.cursor)
+        if changes is None:
+            # El registro se compactó (al arrancar otro proceso o desde el
+            # limpiador): releer la carpeta
+            cursor = change_log.cursor()
+            file_index.rebuild(app.config['UPLOAD_FOLDER'], app.config['SHARDED_LAYOUT'], change_log.published())
+            file_index.version = cursor
+            changes = []
+        
+        # Los cambios propios ya están en el índice; aplicarlos otra vez no cambia nada
+        for entry, after in changes:
+            if entry['op'] == 'get':
+                file_index.touch(entry['name'], entry['at'])
+                continue
+            if entry['op'] == 'add':
+                file_index.add(entry['name'], entry['size'], entry['modified'], entry.get('stored_size'))
+            elif entry['op'] == 'del':
+                file_index.remove(entry['name'])
+            file_index.version = after
+        file_index.cursor = cursor
+
+def republished_entries(entries):
+    """Entradas 'add' vigentes cuya fecha de publicación no es la del disco
+    (enlaces a un blob), las únicas que hay que conservar al compactar"""
+    live = {}
+    for entry in entries:
+        if entry['op'] == 'add':
+            live[entry['name']] = entry
+        elif entry['op'] == 'del':
+            live.pop(entry['name'], None)
+    kept = []
+    for name, entry in live.items():
+        try:
+            mtime = os.stat(stored_path(name)[0]).st_mtime
+        except FileNotFoundError:
+            continue
+        if abs(mtime - entry['modified']) > 1:
+            kept.append(entry)
+    return kept
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, sort):
+    """Cursor opaco -> clave (valor, nombre); ValueError si no es válido.
+    
+    El valor tiene que ser del tipo del orden pedido (texto para name, número
+    para size y modified): si no, comparar con las claves del índice fallaría.
+    """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError(cursor)
+    if not (isinstance(key, list) and len(key) == 2 and isinstance(key[1], str)):
+        raise ValueError(cursor)
+    if sort == 'name':
+        valid = isinstance(key[0], str)
+    else:
+        valid = isinstance(key[0], (int, float)) and not isinstance(key[0], bool)
+    if not valid:
+        raise ValueError(cursor)
+    return tuple(key)
+
+def files_delta(since):
+    """Cambios netos desde el cursor `since`; None si hay que pedir todo de nuevo"""
+    entries, cursor = change_log.since(since)
+    if entries is None:
+        return None
+    
+    added = {}
+    removed = set()
+    for entry in entries:
+        if entry['op'] == 'add':
+            added[entry['name']] = {'name': entry['name'], 'size': entry['size'],
+                                    'modified': entry['modified'],
+                                    'stored_size': entry.get('stored_size', entry['size'])}
+            removed.discard(entry['name'])
+        elif entry['op'] == 'del':
+            added.pop(entry['name'], None)
+            removed.add(entry['name'])
+        elif entry['op'] == 'reset':
+            return None
+    
+    return {'added': list(added.values()), 'removed': sorted(removed), 'cursor': cursor}
+
+def query_files(args, if_none_match):
+    """Lógica de /files, común a la app Flask y a la app ASGI.
+    
+    Devuelve (cuerpo JSON o None, código de estado, etag o None).
+    """
+    # El cursor se toma antes de leer el índice: un cambio simultáneo se
+    # entrega dos veces en el peor caso, nunca se pierde
+    cursor = change_log.cursor()
+    sync_index()
+    # El ETag sólo cambia con el listado, no con las descargas (RETENTION_POLICY=lru)
+    etag = f'files-{file_index.version}'
+    if if_none_match.contains(etag):
+        return None, 304, etag
+    
+    if args.get('since'):
+        delta = files_delta(args['since'])
+        if delta is None:
+            return {'error': 'Cursor caducado, vuelva a pedir el listado completo',
+                    'cursor': cursor}, 410, None
+        return delta, 200, etag
+    
+    sort = args.get('sort', 'name')
+    order = args.get('order', 'asc')
+    if sort not in FileIndex.SORT_KEYS or order not in ('asc', 'desc'):
+        return {'error': 'Parámetros de orden no válidos'}, 400, None
+    
+    limit = args.get('limit', type=int)
+    if limit is not None:
+        limit = max(1, min(limit, 10000))
+    
+    after = None
+    if args.get('cursor'):
+        try:
+            after = decode_cursor(args['cursor'], sort)
+        except ValueError:
+            return {'error': 'Cursor no válido'}, 400, None
+    
+    extensions = {e.strip().lstrip('.').lower()
+                  for e in args.get('ext', '').split(',') if e.strip()}
+    
+    files, last = file_index.page(
+        sort=sort,
+        descending=order == 'desc',
+        after=after,
+        limit=limit,
+        extensions=extensions,
+        prefix=args.get('prefix') or None
+    )
+    
+    payload = {'files': files, 'total': len(files), 'cursor': cursor}
+    if limit is not None:
+        payload['next_cursor'] = encode_cursor(last) if len(files) == limit else None
+    return payload, 200, etag
+
 @app.route('/files', methods=['GET'])
 def list_files():
-    """Endpoint para listar archivos subidos"""
+    """Endpoint para listar archivos subidos
+    
+    Parámetros opcionales: limit y cursor (paginación), sort (name, size o
+    modified), order (asc o desc), ext (extensiones separadas por comas) y
+    prefix. Sin limit se devuelven todos los archivos, como antes.
+    
+    Con since=<cursor> sólo se devuelven los archivos añadidos y borrados
+    desde ese cursor. Si la carpeta no cambió se responde 304 al If-None-Match.
+    """
     try:
-        files = []
-        for filename in os.listdir(app.config['UPLOAD_FOLDER']):
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            if os.path.isfile(filepath):
-                files.append({
-                    'name': filename,
-                    'size': os.path.getsize(filepath),
-                    'modified': os.path.getmtime(filepath)
-                })
-        return jsonify({'files': files, 'total': len(files)}), 200
+        payload, status, etag = query_files(request.args, request.if_none_match)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+    
+    if payload is None:
+        response = app.response_class(status=status)
+    else:
+        response = jsonify(payload)
+        response.status_code = status
+    if etag is not None:
+        response.set_etag(etag)
+    return response
+
+# Con RETENTION_POLICY=lru cada descarga se anota en el registro de cambios
+# (como mucho una vez cada ACCESS_RESOLUTION segundos por archivo) para que
+# el proceso que limpia sepa qué se usó hace poco
+ACCESS_RESOLUTION = 300
+
+def note_access(name):
+    if app.config['RETENTION_POLICY'] != 'lru':
+        return
+    now = time.time()
+    if now - file_index.accessed.get(name, 0) < ACCESS_RESOLUTION:
+        return
+    file_index.touch(name, now)
+    change_log.append({'op': 'get', 'name': name, 'at': now})
+
+def parse_time(value):
+    """Fecha de un parámetro: segundos epoch o ISO 8601 (hora local si no lleva zona)"""
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+@app.route('/catalog', methods=['GET'])
+def query_catalog():
+    """Consultar el catálogo SQLite (CATALOG_ENABLED=1)
+    
+    Filtros opcionales: prefix, ext (separadas por comas), min_size y
+    max_size en bytes, after y before (epoch o ISO 8601, p. ej. 2024-05-01),
+    sha256 y content_type. Orden con sort (name, size o modified) y order;
+    paginación con limit (máximo 1000) y offset.
+    """
+    if catalog is None:
+        return jsonify({'error': 'Catálogo no habilitado'}), 404
+    
+    args = request.args
+    sort = args.get('sort', 'name')
+    order = args.get('order', 'asc')
+    if sort not in Catalog.SORT_COLUMNS or order not in ('asc', 'desc'):
+        return jsonify({'error': 'Parámetros de orden no válidos'}), 400
+    try:
+        limit = max(1, min(int(args.get('limit', 100)), 1000))
+        offset = max(0, int(args.get('offset', 0)))
+        min_size = args.get('min_size', type=int)
+        max_size = args.get('max_size', type=int)
+        after = parse_time(args.get('after'))
+        before = parse_time(args.get('before'))
+    except ValueError:
+        return jsonify({'error': 'Parámetros de consulta no válidos'}), 400
+    
+    extensions = {e.strip().lstrip('.').lower()
+                  for e in args.get('ext', '').split(',') if e.strip()}
+    try:
+        files = catalog.query(
+            prefix=args.get('prefix') or None,
+            extensions=extensions,
+            min_size=min_size,
+            max_size=max_size,
+            after=after,
+            before=before,
+            sha256=args.get('sha256') or None,
+            content_type=args.get('content_type') or None,
+            sort=sort,
+            descending=order == 'desc',
+            limit=limit,
+            offset=offset
+        )
+    except sqlite3.Error as e:
+        return jsonify({'error': str(e)}), 500
+    
+    return jsonify({
+        'files': files,
+        'total': len(files),
+        'next_offset': offset + limit if len(files) == limit else None
+    }), 200
+
+@app.route('/files/<name>', methods=['GET'])
+def download_file(name):
+    """Descargar un archivo subido
+    
+    Admite Range (reanudar descargas, visores de PDF que piden trozos) y
+    responde 304 a If-None-Match / If-Modified-Since. El cuerpo lo envía
+    send_file: con wsgi.file_wrapper del servidor o X-Sendfile del proxy
+    (USE_X_SENDFILE) viaja por sendfile sin pasar por Python.
+    """
+    sync_index()
+    meta = file_index.get(name)
+    if meta is None or secure_filename(name) != name:
+        return jsonify({'error': 'Archivo no encontrado'}), 404
+    size, mtime = meta
+    note_access(name)
+    etag = f'{int(mtime * 1000000):x}-{size:x}'
+    
+    try:
+        filepath, compressed = stored_path(name)
+        if compressed:
+            return send_compressed(name, filepath, size, mtime, etag)
+        return send_file(
+            os.path.abspath(filepath),
+            download_name=name,
+            as_attachment=request.args.get('download') == '1',
+            conditional=True,
+            etag=etag,
+            last_modified=mtime
+        )
+    except FileNotFoundError:
+        return jsonify({'error': 'Archivo no encontrado'}), 404
+
+def send_compressed(name, filepath, size, mtime, etag):
+    """Descarga de un archivo guardado en gzip.
+    
+    Si el cliente acepta gzip se envían los bytes del disco tal cual con
+    Content-Encoding (sin gastar CPU). Si no, o si pide un Range, se
+    descomprime al vuelo: los rangos se refieren siempre al contenido
+    original y para servirlos se descomprime hasta el principio del rango.
+    """
+    mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    as_attachment = request.args.get('download') == '1'
+    if request.accept_encodings['gzip'] > 0 and 'Range' not in request.headers:
+        response = send_file(
+            os.path.abspath(filepath),
+            mimetype=mimetype,
+            download_name=name,
+            as_attachment=as_attachment,
+            conditional=True,
+            etag=f'{etag}-gz',
+            last_modified=mtime
+        )
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        # GzipFile admite seek hacia delante descomprimiendo lo que se salta,
+        # así make_conditional puede recortar el rango sin leerlo a memoria
+        data = wrap_file(request.environ, gzip.open(filepath, 'rb'), CHUNK_SIZE)
+        response = app.response_class(data, mimetype=mimetype, direct_passthrough=True)
+        response.content_length = size
+        response.headers.set('Content-Disposition', 'attachment' if as_attachment else 'inline', filename=name)
+        response.set_etag(etag)
+        response.last_modified = mtime
+        response.cache_control.no_cache = True
+        response = response.make_conditional(request.environ, accept_ranges=True, complete_length=size)
+    response.vary.add('Accept-Encoding')
+    return response
+
+class ZipStream:
+    """Destino sin seek para zipfile: guarda lo escrito hasta que se entrega"""
+    
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+    
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+    
+    def tell(self):
+        return self.offset
+    
+    def flush(self):
+        pass
+    
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def export_selection(args, data):
+    """Archivos a exportar: lista de nombres o filtros como los de /files.
+    
+    Devuelve (lista de (nombre, tamaño, fecha), nombres desconocidos), o
+    (None, []) si no se indicó ni nombres ni filtros.
+    """
+    names = data.get('names') if isinstance(data.get('names'), list) else None
+    if names is None and args.get('names'):
+        names = args['names'].split(',')
+    
+    if names is not None:
+        selection = []
+        missing = []
+        for name in dict.fromkeys(str(n) for n in names):
+            meta = file_index.get(name)
+            if meta is None:
+                missing.append(name)
+            else:
+                selection.append((name, meta[0], meta[1]))
+        return selection, missing
+    
+    if not any(args.get(key) for key in ('ext', 'prefix', 'modified_after', 'modified_before')):
+        return None, []
+    
+    modified_after = args.get('modified_after', type=float)
+    modified_before = args.get('modified_before', type=float)
+    extensions = {e.strip().lstrip('.').lower()
+                  for e in args.get('ext', '').split(',') if e.strip()}
+    files, _ = file_index.page(
+        sort='modified',
+        after=(modified_after, '') if modified_after is not None else None,
+        extensions=extensions,
+        prefix=args.get('prefix') or None
+    )
+    selection = [(f['name'], f['size'], f['modified']) for f in files
+                 if modified_before is None or f['modified'] < modified_before]
+    return selection, []
+
+def zip_chunks(selection):
+    """Genera el ZIP por trozos leyendo cada archivo por bloques: la memoria
+    usada no depende del tamaño total"""
+    sink = ZipStream()
+    with zipfile.ZipFile(sink, 'w') as archive:
+        for name, size, mtime in selection:
+            info = zipfile.ZipInfo(name, time.localtime(max(mtime, 315532800))[:6])
+            info.file_size = size  # decide por adelantado si hace falta ZIP64
+            extension = os.path.splitext(name)[1][1:].lower()
+            info.compress_type = zipfile.ZIP_STORED if extension in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+            try:
+                source, _ = open_logical(name)
+            except FileNotFoundError:
+                continue  # borrado después de empezar la respuesta
+            with source, archive.open(info, 'w') as dest:
+                for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+                    dest.write(chunk)
+                    yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
+
+@app.route('/export', methods=['GET', 'POST'])
+def export_files():
+    """Descargar varios archivos en un ZIP generado al vuelo
+    
+    Se elige con names (separados por comas, o {"names": [...]} por POST) o
+    con los filtros ext, prefix, modified_after y modified_before (epoch).
+    """
+    sync_index()
+    data = (request.get_json(silent=True) or {}) if request.method == 'POST' else {}
+    selection, missing = export_selection(request.args, data)
+    # Sin selección no se exporta la carpeta entera por descuido
+    if selection is None:
+        return jsonify({'error': 'Indique names o algún filtro (ext, prefix, modified_after, modified_before)'}), 400
+    if missing:
+        return jsonify({'error': 'Archivos no encontrados', 'missing': missing}), 404
+    
+    filename = f"export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+    response = app.response_class(stream_with_context(zip_chunks(selection)), mimetype='application/zip')
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    return response
+
+@app.route('/relay', methods=['GET'])
+def relay_status():
+    """Estado de la cola de reenvío al procesador externo"""
+    if relay_queue is None:
+        return jsonify({'enabled': False}), 200
+    return jsonify({'enabled': True, 'url': app.config['RELAY_URL'], **relay_queue.status()}), 200
+
+EVENTS_POLL_INTERVAL = 0.5  # segundos entre lecturas del registro de eventos
+EVENTS_HEARTBEAT = 15  # comentario de mantenimiento para que los proxies no corten
+
+def events_since(cursor):
+    """Mensajes SSE de los eventos anotados desde `cursor`.
+    
+    Devuelve (texto, cursor nuevo). El último mensaje lleva el cursor como
+    id, así EventSource lo reenvía en Last-Event-ID al reconectar. Si el
+    cursor ya no vale (el registro se compactó) se envía un evento 'reset'
+    y se sigue desde el final.
+    """
+    entries, new_cursor = event_log.since(cursor)
+    if entries is None:
+        new_cursor = event_log.cursor()
+        return f'event: reset\ndata: {{}}\nid: {new_cursor}\n\n', new_cursor
+    if new_cursor == cursor:
+        return '', cursor
+    messages = [f"event: {entry['event']}\ndata: {json.dumps(entry['data'])}\n"
+                for entry in entries if entry['op'] == 'event']
+    # Sin eventos (sólo la marca de arranque de otro worker) basta con avanzar el id
+    messages.append(f'id: {new_cursor}\n\n')
+    return '\n'.join(messages), new_cursor
+
+event_streams = {'lock': threading.Lock(), 'open': 0}  # conexiones a /events de este proceso
+
+def event_cursor():
+    """Cursor de partida de /events: Last-Event-ID, ?cursor= o el final del registro"""
+    return request.headers.get('Last-Event-ID') or request.args.get('cursor') or event_log.cursor()
+
+@app.route('/events', methods=['GET'])
+def processing_events():
+    """Avance del post-procesado como Server-Sent Events.
+    
+    Eventos 'queued', 'progress' y 'done' con el nombre del archivo. Cada
+    conexión dura EVENTS_MAX_DURATION segundos y el navegador reconecta
+    donde lo dejó. Aquí cada conexión ocupa un hilo, así que se admiten
+    EVENTS_MAX_STREAMS por proceso; el servidor asíncrono (serve.py --asgi)
+    las sirve sin hilos y sin ese límite.
+    """
+    if post_processor is None:
+        return jsonify({'error': 'Post-procesado desactivado'}), 404
+    with event_streams['lock']:
+        if event_streams['open'] >= app.config['EVENTS_MAX_STREAMS']:
+            response = jsonify({'error': 'Demasiadas conexiones a /events, reintente más tarde'})
+            response.status_code = 503
+            response.headers['Retry-After'] = str(app.config['EVENTS_MAX_DURATION'])
+            return response
+        event_streams['open'] += 1
+    cursor = event_cursor()
+    
+    def stream(cursor):
+        yield f'retry: 2000\nid: {cursor}\n\n'
+        deadline = time.monotonic() + app.config['EVENTS_MAX_DURATION']
+        last_sent = time.monotonic()
+        while time.monotonic() < deadline:
+            text, cursor = events_since(cursor)
+            if text:
+                yield text
+                last_sent = time.monotonic()
+            elif time.monotonic() - last_sent > EVENTS_HEARTBEAT:
+                yield ': ping\n\n'
+                last_sent = time.monotonic()
+            time.sleep(EVENTS_POLL_INTERVAL)
+    
+    def release():
+        with event_streams['lock']:
+            event_streams['open'] -= 1
+    
+    response = app.response_class(stream(cursor), mimetype='text/event-stream')
+    response.call_on_close(release)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # nginx: enviar cada evento al momento
+    return response
+
+@app.route('/files/<name>/meta', methods=['GET'])
+def file_meta(name):
+    """Resultados del post-procesado de un archivo (los pasos que faltan no aparecen)"""
+    if post_processor is None:
+        return jsonify({'error': 'Post-procesado desactivado'}), 404
+    sync_index()
+    if file_index.get(name) is None or secure_filename(name) != name:
+        return jsonify({'error': 'Archivo no encontrado'}), 404
+    meta = post_processor.load(name) or {'name': name, 'results': {}}
+    meta.pop('key', None)
+    meta['steps'] = post_processor.steps
+    meta['complete'] = all(step in meta['results'] for step in post_processor.steps)
+    return jsonify(meta), 200
+
+@app.route('/files/<name>/meta', methods=['POST'])
+def reprocess_file(name):
+    """Volver a encolar el post-procesado: los pasos que faltan o fallaron,
+    o todos con ?force=1"""
+    if post_processor is None:
+        return jsonify({'error': 'Post-procesado desactivado'}), 404
+    sync_index()
+    meta = file_index.get(name)
+    if meta is None or secure_filename(name) != name:
+        return jsonify({'error': 'Archivo no encontrado'}), 404
+    size, mtime = meta
+    try:
+        filepath, _ = stored_path(name)
+    except FileNotFoundError:
+        return jsonify({'error': 'Archivo no encontrado'}), 404
+    
+    # El SHA-256 de la subida quedó como clave de los metadatos
+    previous = post_processor.load(name)
+    digest = previous['key'] if previous and DIGEST_RE.match(previous['key']) else None
+    steps = post_processor.submit(name, filepath, size, mtime, digest, request.args.get('force') == '1')
+    return jsonify({'name': name, 'queued': steps}), 202
+
+@app.cli.command('shard-migrate')
+@click.option('--reverse', is_flag=True, help='Devolver los archivos a la carpeta plana.')
+def shard_migrate(reverse):
+    """Repartir los archivos de la carpeta plana en subcarpetas por hash.
+    
+    Ejecutar con el servidor detenido y arrancarlo después con
+    SHARDED_LAYOUT=1 (o sin él, si se usó --reverse).
+    """
+    folder = app.config['UPLOAD_FOLDER']
+    moved = skipped = 0
+    
+    # Se materializa la lista antes de mover para no recorrer lo recién movido
+    for filename, entry in list(scan_files(folder, sharded=reverse)):
+        # La subcarpeta sale del nombre visible; el archivo conserva su nombre en disco
+        if reverse:
+            target = os.path.join(folder, entry.name)
+        else:
+            target = os.path.join(shard_dir(folder, filename), entry.name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+        
+        if os.path.exists(target):
+            click.echo(f'Omitido, ya existe: {target}')
+            skipped += 1
+            continue
+        os.rename(entry.path, target)
+        moved += 1
+        if reverse:
+            # Borrar las subcarpetas que quedan vacías (falla si no lo están)
+            level2 = os.path.dirname(entry.path)
+            for shard in (level2, os.path.dirname(level2)):
+                try:
+                    os.rmdir(shard)
+                except OSError:
+                    break
+    
+    click.echo(f'Archivos movidos: {moved}, omitidos: {skipped}')
+
+@app.cli.command('catalog-rebuild')
+@click.option('--rehash', is_flag=True, help='Recalcular el SHA-256 de todos los archivos.')
+def catalog_rebuild(rehash):
+    """Reconstruir el catálogo SQLite a partir de la carpeta de uploads.
+    
+    Sólo se leen los archivos nuevos o modificados (salvo con --rehash); las
+    filas de archivos que ya no existen se borran. Se puede ejecutar con el
+    servidor en marcha.
+    """
+    target = catalog or Catalog(app.config['CATALOG_PATH'])
+    added, removed = target.rebuild(app.config['UPLOAD_FOLDER'], app.config['SHARDED_LAYOUT'], rehash,
+                                    change_log.published())
+    click.echo(f'Archivos catalogados: {added}, eliminados del catálogo: {removed}')
+
+# Histograma de latencia sólo para las rutas calientes
+TIMED_ENDPOINTS = {'upload_file', 'list_files'}
+
+def record_ingest_time(size, elapsed, write_time):
+    metrics.inc('upload_received_bytes_total', size)
+    metrics.inc('upload_ingest_seconds_total', elapsed)
+    metrics.inc('upload_disk_write_seconds_total', write_time)
+    metrics.inc('upload_network_receive_seconds_total', max(0.0, elapsed - write_time))
+
+def record_ingest(files, elapsed):
+    """Contabilizar un cuerpo multipart ya leído (partes IngestFile)"""
+    record_ingest_time(
+        sum(f.size for f in files),
+        elapsed,
+        sum(f.write_time for f in files)
+    )
+
+def record_request(endpoint, method, status, elapsed):
+    metrics.inc('http_requests_total', endpoint=endpoint or 'none', method=method, status=status)
+    if endpoint in TIMED_ENDPOINTS:
+        metrics.observe('http_request_duration_seconds', elapsed, endpoint=endpoint)
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Métricas de todos los workers en formato de texto de Prometheus"""
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# Registrado antes que los demás before_request para medir también los rechazos
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def count_request(response):
+    if 'request_start' in g:
+        record_request(request.endpoint, request.method, response.status_code,
+                       time.perf_counter() - g.request_start)
+    return response
+
+def request_size_limit(endpoint):
+    """Content-Length máximo que acepta un endpoint de subida"""
+    limit = app.config['MAX_CONTENT_LENGTH']
+    if endpoint == 'upload_file':
+        # Una sola parte: el archivo más las cabeceras multipart
+        limit = min(limit, app.config['MAX_FILE_SIZE'] + MULTIPART_OVERHEAD)
+    return limit
+
+@app.before_request
+def reject_oversized():
+    """Rechazar por Content-Length antes de leer el cuerpo.
+    
+    Como no se toca el cuerpo, un servidor que respeta Expect: 100-continue
+    (uvicorn, ver serve.py) responde 413 sin pedir al cliente que lo envíe.
+    """
+    length = request.content_length
+    limit = request_size_limit(request.endpoint)
+    if length is not None and limit is not None and length > limit:
+        return too_large(None)
+
+UPLOAD_ENDPOINTS = {'upload_file', 'upload_batch', 'upload_session_chunk'}
+
+disk_free_cache = {'at': 0.0, 'free': None}
+
+def disk_free():
+    """Espacio libre en la carpeta de uploads, consultado como mucho una vez por segundo"""
+    now = time.monotonic()
+    if now - disk_free_cache['at'] > 1:
+        disk_free_cache['free'] = shutil.disk_usage(app.config['UPLOAD_FOLDER']).free
+        disk_free_cache['at'] = now
+    return disk_free_cache['free']
+
+def storage_rejection(length):
+    """Comprobación barata de espacio antes de leer el cuerpo.
+    
+    Devuelve None si la subida cabe o (cuerpo JSON, 507, Retry-After) si no.
+    Superar la cuota no rechaza: despierta al limpiador, que hace sitio.
+    """
+    quota = app.config['STORAGE_QUOTA']
+    if quota and length > quota:
+        return {'error': 'El archivo no cabe en la cuota de almacenamiento'}, 507, None
+    if disk_free() - upload_admission.bytes < length + app.config['DISK_RESERVE']:
+        janitor.trigger()
+        return {'error': 'No queda espacio en disco, reintente más tarde'}, 507, app.config['JANITOR_INTERVAL']
+    if quota and file_index.total_bytes + upload_admission.bytes + length > quota:
+        janitor.trigger()
+    return None
+
+def admit_request(client, length):
+    """Pasar una subida por el control de admisión.
+    
+    Devuelve None si se admite (hay que llamar a upload_admission.release)
+    o (cuerpo JSON, código, Retry-After o None) para rechazarla.
+    """
+    if length is None:
+        length = app.config['MAX_FILE_SIZE']
+    rejected = storage_rejection(length)
+    if rejected is not None:
+        return rejected
+    rejected = upload_admission.acquire(client, length)
+    if rejected is None:
+        return None
+    status, wait = rejected
+    if status == 429:
+        return {'error': 'Demasiadas subidas, espere antes de reintentar'}, 429, max(1, round(wait))
+    return {'error': 'Servidor ocupado, reintente en unos segundos'}, 503, app.config['RETRY_AFTER']
+
+@app.before_request
+def admit_upload():
+    """Rechazar rápido (503/429 con Retry-After) las subidas que no caben"""
+    if request.endpoint not in UPLOAD_ENDPOINTS:
+        return None
+    length = request.content_length
+    rejected = admit_request(request.remote_addr, length)
+    if rejected is not None:
+        payload, status, retry_after = rejected
+        response = jsonify(payload)
+        response.status_code = status
+        if retry_after is not None:
+            response.headers['Retry-After'] = str(retry_after)
+        return response
+    g.admitted_length = length if length is not None else app.config['MAX_FILE_SIZE']
+
+@app.teardown_request
+def release_upload(exc):
+    if 'admitted_length' in g:
+        upload_admission.release(g.pop('admitted_length'))
+
+def size_label(size):
+    """Tamaño en MB para los mensajes (p. ej. '50 MB')"""
+    return f'{size / (1024 * 1024):g} MB'
+
+def too_large_message():
+    return f"Archivo demasiado grande. Máximo {size_label(app.config['MAX_FILE_SIZE'])} por archivo"
 
 @app.errorhandler(413)
 def too_large(e):
-    return jsonify({'error': 'Archivo demasiado grande. Máximo 50 MB por archivo'}), 413
+    return jsonify({'error': too_large_message()}), 413
+
+# Los hilos de fondo sólo arrancan al servir (serve.py, asgi.py, python app.py
+# o la primera petición con flask run / gunicorn), nunca al importar: los
+# comandos de flask como shard-migrate no deben tener al limpiador borrando
+# a la vez que mueven archivos.
+services = {'lock': threading.Lock(), 'started': False}
+
+def start_services():
+    """Arrancar el post-procesado, el reenvío, el limpiador y el volcado de métricas"""
+    with services['lock']:
+        if services['started']:
+            return
+        services['started'] = True
+        # El pool de post-procesado va primero: sus procesos se crean con fork
+        # y así no heredan un proceso con otros hilos en marcha
+        if post_processor is not None:
+            post_processor.start()
+        if relay_queue is not None:
+            relay_queue.start()
+        janitor.start()
+        metrics.start(app.config['METRICS_FLUSH_INTERVAL'])
+
+@app.before_request
+def ensure_services():
+    if not services['started']:
+        start_services()
 
 if __name__ == '__main__':
+    start_services()
     print("=" * 60)
     print("🚀 Servidor Flask - Subida Múltiple de Archivos")
     print("=" * 60)
     print(f"📱 URL: https://browser-file-ica.onrender.com")
     print(f"📁 Carpeta de uploads: {os.path.abspath(UPLOAD_FOLDER)}")
-    print(f"📊 Límite por archivo: 50 MB")
-    print(f"📦 Límite total: 100 MB")
+    print(f"📊 Límite por archivo: {size_label(app.config['MAX_FILE_SIZE'])}")
+    print(f"📦 Límite total: {size_label(app.config['MAX_CONTENT_LENGTH'])}")
     print("=" * 60)
     print("\n⏳ Abriendo navegador...\n")
     print("Presiona Ctrl+C para detener el servidor\n")
@@ -0,0 +1,215 @@
+"""App ASGI (FastAPI) con /upload, /files y /events asíncronos.
+
+El cuerpo de /upload se lee por bloques desde el bucle de eventos y cada
+escritura en disco se hace en el pool de hilos, así miles de clientes lentos
+no ocupan un hilo cada uno mientras suben. El resto de rutas sigue siendo la
+app Flask de app.py, montada debajo. Las respuestas tienen el mismo JSON.
+Las conexiones abiertas a /events esperan en el bucle de eventos, no en un hilo.
+
+    python serve.py --asgi
+"""
+import asyncio
+import os
+import time
+
+from a2wsgi import WSGIMiddleware
+from fastapi import FastAPI, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from werkzeug.datastructures import FileStorage, MultiDict
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import parse_etags, parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, File, MultipartDecoder, NeedData
+
+import app as core
+
+# Aquí /events no ocupa hilos: la página ya puede seguir el post-procesado
+core.app.config['ASYNC_EVENTS'] = True
+
+api = FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
+api.add_middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'],
+                   expose_headers=['Retry-After'])
+
+
+class BadMultipart(Exception):
+    pass
+
+
+async def receive_files(request):
+    """Lee el cuerpo multipart por bloques y escribe cada parte de archivo en
+    un IngestFile. Devuelve una lista de (campo, FileStorage)."""
+    content_type, options = parse_options_header(request.headers.get('content-type', ''))
+    boundary = options.get('boundary')
+    if content_type != 'multipart/form-data' or not boundary:
+        raise BadMultipart()
+
+    max_length = core.app.config['MAX_CONTENT_LENGTH']
+    decoder = MultipartDecoder(
+        boundary.encode('latin-1'),
+        max_form_memory_size=core.app.config['MAX_FORM_MEMORY_SIZE'],
+        max_parts=core.app.config['MAX_FORM_PARTS'],
+    )
+
+    files = []
+    current = None
+    finished = False
+
+    async def feed(chunk):
+        nonlocal current, finished
+        decoder.receive_data(chunk)
+        event = decoder.next_event()
+        while not isinstance(event, (Epilogue, NeedData)):
+            if isinstance(event, File):
+                current = await run_in_threadpool(core.new_ingest_file, event.filename)
+                files.append((event.name, FileStorage(current, event.filename, event.name,
+                                                      headers=event.headers)))
+            elif isinstance(event, Data) and current is not None:
+                await run_in_threadpool(current.write, event.data)
+                if not event.more_data:
+                    # Fin de la parte: se libera el descriptor hasta publicarla
+                    await run_in_threadpool(current.detach)
+                    current = None
+            event = decoder.next_event()
+        finished = finished or isinstance(event, Epilogue)
+
+    received = 0
+    start = time.perf_counter()
+    try:
+        async for chunk in request.stream():
+            if not chunk:
+                continue
+            received += len(chunk)
+            if max_length is not None and received > max_length:
+                raise RequestEntityTooLarge()
+            await feed(chunk)
+        await feed(None)
+    except BaseException:
+        await close_files(files)
+        raise
+    finally:
+        core.record_ingest([f.stream for _, f in files], time.perf_counter() - start)
+
+    if not finished:
+        await close_files(files)
+        raise BadMultipart()
+    return files
+
+
+async def close_files(files):
+    for _, file in files:
+        await run_in_threadpool(file.stream.close)
+
+
+def timed(endpoint):
+    """Contabiliza la petición en /metrics igual que los hooks de la app Flask"""
+    def decorator(handler):
+        async def wrapper(request: Request):
+            start = time.perf_counter()
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status_code
+                return response
+            finally:
+                core.record_request(endpoint, request.method, status, time.perf_counter() - start)
+        wrapper.__name__ = handler.__name__
+        wrapper.__doc__ = handler.__doc__
+        return wrapper
+    return decorator
+
+
+@api.post('/upload')
+@timed('upload_file')
+async def upload_file(request: Request):
+    """Endpoint para subir un archivo"""
+    # Se rechaza antes de leer el cuerpo: uvicorn no envía 100 Continue
+    length = request.headers.get('content-length')
+    if length and length.isdigit() and int(length) > core.request_size_limit('upload_file'):
+        return JSONResponse({'error': core.too_large_message()}, 413)
+
+    length = int(length) if length and length.isdigit() else core.app.config['MAX_FILE_SIZE']
+    rejected = core.admit_request(request.client.host if request.client else None, length)
+    if rejected is not None:
+        payload, status, retry_after = rejected
+        headers = {'Retry-After': str(retry_after)} if retry_after is not None else None
+        return JSONResponse(payload, status, headers=headers)
+    try:
+        return await receive_and_save(request)
+    finally:
+        core.upload_admission.release(length)
+
+
+async def receive_and_save(request):
+    """Lee el multipart de /upload y guarda el archivo ya admitido"""
+    try:
+        files = await receive_files(request)
+    except RequestEntityTooLarge:
+        return JSONResponse({'error': core.too_large_message()}, 413)
+    except BadMultipart:
+        return JSONResponse({'error': 'No se encontró ningún archivo'}, 400)
+
+    try:
+        file = next((f for name, f in files if name == 'file'), None)
+        if file is None:
+            return JSONResponse({'error': 'No se encontró ningún archivo'}, 400)
+        if file.filename == '':
+            return JSONResponse({'error': 'No se seleccionó ningún archivo'}, 400)
+
+        try:
+            result = await run_in_threadpool(core.save_upload, file)
+        except Exception as e:
+            return JSONResponse({'error': f'Error al guardar el archivo: {str(e)}'}, 500)
+        return JSONResponse({'message': 'Archivo subido exitosamente', **result})
+    finally:
+        await close_files(files)
+
+
+@api.get('/files')
+@timed('list_files')
+async def list_files(request: Request):
+    """Endpoint para listar archivos subidos"""
+    args = MultiDict(request.query_params.multi_items())
+    if_none_match = parse_etags(request.headers.get('if-none-match'))
+    try:
+        payload, status, etag = await run_in_threadpool(core.query_files, args, if_none_match)
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, 500)
+
+    headers = {'ETag': f'"{etag}"'} if etag is not None else None
+    if payload is None:
+        return Response(status_code=status, headers=headers)
+    return JSONResponse(payload, status, headers=headers)
+
+
+@api.get('/events')
+async def processing_events(request: Request):
+    """Avance del post-procesado como Server-Sent Events (igual que en app.py)"""
+    if core.post_processor is None:
+        return JSONResponse({'error': 'Post-procesado desactivado'}, 404)
+    cursor = (request.headers.get('last-event-id') or request.query_params.get('cursor')
+              or await run_in_threadpool(core.event_log.cursor))
+    
+    async def stream(cursor):
+        yield f'retry: 2000\nid: {cursor}\n\n'
+        deadline = time.monotonic() + core.app.config['EVENTS_MAX_DURATION']
+        last_sent = time.monotonic()
+        while time.monotonic() < deadline and not await request.is_disconnected():
+            text, cursor = await run_in_threadpool(core.events_since, cursor)
+            if text:
+                yield text
+                last_sent = time.monotonic()
+            elif time.monotonic() - last_sent > core.EVENTS_HEARTBEAT:
+                yield ': ping\n\n'
+                last_sent = time.monotonic()
+            await asyncio.sleep(core.EVENTS_POLL_INTERVAL)
+    
+    return StreamingResponse(stream(cursor), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# Todo lo demás lo sirve la app Flask
+api.mount('/', WSGIMiddleware(core.app, workers=int(os.environ.get('SERVE_THREADS', 16))))
+
+# Importar este módulo es servir: arrancan los hilos de fondo de app.py
+core.start_services()
@@ -0,0 +1,336 @@
+"""Benchmark reproducible de /upload y /files.
+
+Arranca serve.py en una carpeta temporal, lanza subidas de varios tamaños con
+distinta concurrencia y listados contra carpetas de 1k, 10k y 100k archivos,
+e imprime un JSON con rendimiento y latencias p50/p95/p99 por escenario.
+
+    python bench.py --output base.json
+    python bench.py --baseline base.json     # sale con código 1 si hay regresiones
+    python bench.py --quick                  # versión corta para probar
+"""
+import http.client
+import json
+import math
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import click
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+UPLOAD_SIZES = (1024, 64 * 1024, 1024 * 1024, 10 * 1024 * 1024, 50 * 1024 * 1024)
+UPLOAD_CONCURRENCY = (1, 8, 32)
+LIST_FOLDERS = (1000, 10000, 100000)
+LIST_CONCURRENCY = (1, 8)
+
+
+def percentile(values, fraction):
+    """Percentil por rango más cercano de una lista ya ordenada"""
+    if not values:
+        return None
+    index = max(0, math.ceil(fraction * len(values)) - 1)
+    return values[index]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def multipart_body(size):
+    """Cuerpo multipart con un único archivo de `size` bytes"""
+    boundary = uuid.uuid4().hex
+    head = (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="file"; filename="bench_{size}.bin"\r\n'
+        'Content-Type: application/octet-stream\r\n\r\n'
+    ).encode('ascii')
+    tail = f'\r\n--{boundary}--\r\n'.encode('ascii')
+    return head + os.urandom(size) + tail, f'multipart/form-data; boundary={boundary}'
+
+
+def populate(folder, count):
+    """Llenar la carpeta de uploads con `count` archivos pequeños"""
+    os.makedirs(folder, exist_ok=True)
+    for i in range(count):
+        with open(os.path.join(folder, f'file_{i:06d}.txt'), 'wb') as f:
+            f.write(b'x' * (i % 4096))
+
+
+class Server:
+    """serve.py en un subproceso, con su propia carpeta de trabajo"""
+
+    def __init__(self, workdir, workers, asgi, env):
+        self.workdir = workdir
+        self.port = free_port()
+        args = [sys.executable, os.path.join(ROOT, 'serve.py'),
+                '--host', '127.0.0.1', '--port', str(self.port), '--workers', str(workers)]
+        if asgi:
+            args.append('--asgi')
+        environment = dict(os.environ, **env)
+        environment['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')]))
+        self.process = subprocess.Popen(args, cwd=workdir, env=environment,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.wait_ready()
+
+    def wait_ready(self, timeout=120):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise click.ClickException('El servidor terminó al arrancar')
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5)
+                conn.request('GET', '/files?limit=1')
+                conn.getresponse().read()
+                conn.close()
+                return
+            except OSError:
+                time.sleep(0.2)
+        self.stop()
+        raise click.ClickException('El servidor no respondió a tiempo')
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+def run_load(port, concurrency, requests, make_request):
+    """Lanzar `requests` peticiones con `concurrency` conexiones keep-alive.
+
+    make_request(conn) hace una petición y devuelve (código, bytes enviados).
+    Rendimiento y latencias cuentan sólo las respuestas 2xx: un servidor que
+    contesta rápido con 413/503/507 no debe parecer más rápido.
+    """
+    latencies = []
+    statuses = {}
+    sent = [0]
+    succeeded = [0]
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def worker():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    break
+                remaining[0] -= 1
+            start = time.perf_counter()
+            try:
+                status, size = make_request(conn)
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                status, size = 'error', 0
+            elapsed = time.perf_counter() - start
+            with lock:
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+                if isinstance(status, int) and 200 <= status < 300:
+                    latencies.append(elapsed)
+                    sent[0] += size
+                    succeeded[0] += 1
+        conn.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'concurrency': concurrency,
+        'requests': requests,
+        'succeeded': succeeded[0],
+        'error_rate': round(1 - succeeded[0] / requests, 4),
+        'statuses': statuses,
+        'seconds': round(wall, 4),
+        'requests_per_second': round(succeeded[0] / wall, 2),
+        'megabytes_per_second': round(sent[0] / wall / 1024 / 1024, 2),
+        'latency_ms': {
+            name: round(percentile(latencies, fraction) * 1000, 2) if latencies else None
+            for name, fraction in (('p50', 0.50), ('p95', 0.95), ('p99', 0.99))
+        },
+    }
+
+
+def clear_uploads(folder):
+    """Borrar los archivos subidos entre escenarios (no las carpetas internas
+    como .incoming o .journal, que el servidor sigue usando)"""
+    for entry in os.scandir(folder):
+        if not entry.name.startswith('.') and entry.is_file():
+            os.remove(entry.path)
+
+
+def bench_uploads(server, sizes, concurrencies, budget):
+    results = []
+    for size in sizes:
+        body, content_type = multipart_body(size)
+        headers = {'Content-Type': content_type, 'Content-Length': str(len(body))}
+
+        def make_request(conn):
+            conn.request('POST', '/upload', body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            return response.status, len(body)
+
+        for concurrency in concurrencies:
+            # Tantas peticiones como quepan en el presupuesto de bytes
+            requests = min(1000, budget // size)
+            name = f'upload/{size}/c{concurrency}'
+            if requests < concurrency:
+                click.echo(f'{name}: omitido, el presupuesto da {requests} peticiones para '
+                           f'{concurrency} conexiones (suba --budget-mb)', err=True)
+                continue
+            result = run_load(server.port, concurrency, requests, make_request)
+            clear_uploads(os.path.join(server.workdir, 'uploads'))
+            result['name'] = name
+            result['size'] = size
+            results.append(result)
+            click.echo(f"{result['name']}: {result['requests_per_second']} req/s, "
+                       f"p95 {result['latency_ms']['p95']} ms, "
+                       f"errores {result['error_rate']:.1%}", err=True)
+    return results
+
+
+def bench_listing(server, count, concurrencies, requests):
+    results = []
+    for query in ('/files', '/files?limit=100&sort=modified&order=desc'):
+        def make_request(conn):
+            conn.request('GET', query)
+            response = conn.getresponse()
+            response.read()
+            return response.status, 0
+
+        for concurrency in concurrencies:
+            result = run_load(server.port, concurrency, requests, make_request)
+            result['name'] = f'files/{count}/{"page" if "limit" in query else "all"}/c{concurrency}'
+            result['files'] = count
+            result['query'] = query
+            results.append(result)
+            click.echo(f"{result['name']}: {result['requests_per_second']} req/s, "
+                       f"p95 {result['latency_ms']['p95']} ms, "
+                       f"errores {result['error_rate']:.1%}", err=True)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Escenarios con respuestas que no son 2xx o cuyo p95 subió o cuyo
+    rendimiento bajó más de `tolerance`"""
+    previous = {r['name']: r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        if result['error_rate']:
+            regressions.append({'name': result['name'], 'metric': 'error_rate',
+                                'baseline': previous.get(result['name'], {}).get('error_rate'),
+                                'current': result['error_rate']})
+        base = previous.get(result['name'])
+        if base is None:
+            continue
+        p95, base_p95 = result['latency_ms']['p95'], base['latency_ms']['p95']
+        if base_p95 and p95 is not None and p95 > base_p95 * (1 + tolerance):
+            regressions.append({'name': result['name'], 'metric': 'p95_ms', 'baseline': base_p95, 'current': p95})
+        rps, base_rps = result['requests_per_second'], base['requests_per_second']
+        if base_rps and rps < base_rps * (1 - tolerance):
+            regressions.append({'name': result['name'], 'metric': 'requests_per_second',
+                                'baseline': base_rps, 'current': rps})
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.command()
+@click.option('--workers', type=int, default=1, show_default=True,
+              help='Procesos trabajadores de serve.py.')
+@click.option('--asgi', is_flag=True, help='Medir la app asíncrona de asgi.py.')
+@click.option('--budget-mb', type=int, default=256, show_default=True,
+              help='Megabytes a subir por escenario de subida.')
+@click.option('--list-requests', type=int, default=200, show_default=True,
+              help='Peticiones por escenario de listado.')
+@click.option('--quick', is_flag=True, help='Escenarios reducidos para una prueba rápida.')
+@click.option('--output', type=click.Path(dir_okay=False), help='Guardar el JSON en un archivo.')
+@click.option('--baseline', type=click.File('r'), help='JSON de una ejecución anterior para comparar.')
+@click.option('--tolerance', type=float, default=0.2, show_default=True,
+              help='Empeoramiento relativo admitido antes de marcar una regresión.')
+def main(workers, asgi, budget_mb, list_requests, quick, output, baseline, tolerance):
+    """Benchmark de subida y listado contra un servidor local"""
+    sizes, concurrencies, folders = UPLOAD_SIZES, UPLOAD_CONCURRENCY, LIST_FOLDERS
+    if quick:
+        sizes, concurrencies, folders = UPLOAD_SIZES[:3], UPLOAD_CONCURRENCY[:2], LIST_FOLDERS[:1]
+        budget_mb, list_requests = 16, 50
+
+    # Sin límites de admisión: se mide el camino de subida, no el rechazo con 503
+    env = {'MAX_INFLIGHT_UPLOADS': '100000', 'MAX_INFLIGHT_BYTES': str(1 << 50),
+           'UPLOAD_RATE_LIMIT': '0', 'RELAY_URL': '', 'CAS_ENABLED': '0',
+           'CLIENT_UPLOAD_URL': '/upload'}
+    results = []
+
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    try:
+        folder = os.path.join(workdir, 'upload')
+        os.makedirs(folder)
+        server = Server(folder, workers, asgi, env)
+        try:
+            results += bench_uploads(server, sizes, concurrencies, budget_mb * 1024 * 1024)
+        finally:
+            server.stop()
+
+        for count in folders:
+            folder = os.path.join(workdir, f'list_{count}')
+            populate(os.path.join(folder, 'uploads'), count)
+            server = Server(folder, workers, asgi, env)
+            try:
+                results += bench_listing(server, count, LIST_CONCURRENCY, list_requests)
+            finally:
+                server.stop()
+            shutil.rmtree(folder, ignore_errors=True)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'workers': workers,
+        'asgi': asgi,
+        'results': results,
+    }
+    regressions = None
+    if baseline is not None:
+        previous = json.load(baseline)
+        regressions = compare(results, previous, tolerance)
+        report['baseline_revision'] = previous.get('revision')
+        report['regressions'] = regressions
+
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    click.echo(text)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
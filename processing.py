@@ -0,0 +1,241 @@
+"""Pasos de post-procesado de los archivos subidos.
+
+Cada paso es una función registrada con @step('nombre') que recibe la ruta en
+disco y un dict con name, size, sha256 y compressed (si está guardado en
+gzip), y devuelve un dict JSON con su resultado o None si no aplica a ese
+archivo. Se ejecutan en un pool de procesos aparte (PostProcessor en app.py).
+
+Este módulo no importa app.py: los procesos del pool sólo cargan esto y los
+módulos de PROCESSING_PLUGINS, que pueden registrar pasos propios.
+"""
+import codecs
+import gzip
+import hashlib
+import importlib
+import mimetypes
+import mmap
+import os
+import re
+import signal
+import tarfile
+import threading
+import time
+import zipfile
+
+try:
+    import pypdf
+except ImportError:  # Sin pypdf las páginas se cuentan leyendo el PDF a mano
+    pypdf = None
+
+CHUNK_SIZE = 1024 * 1024
+HEAD_SIZE = 512  # bytes que se leen para reconocer el formato
+ARCHIVE_MAX_ENTRIES = 1000  # entradas que se listan como mucho por archivo comprimido
+PDF_MAX_READ = 256 * 1024 * 1024  # de un PDF guardado en gzip sólo se descomprime esto
+PARENT_CHECK_INTERVAL = 5  # segundos entre comprobaciones de que el worker sigue vivo
+
+STEPS = {}
+
+
+def step(name):
+    """Registrar una función como paso de post-procesado"""
+    def register(fn):
+        STEPS[name] = fn
+        return fn
+    return register
+
+
+def load_plugins(modules):
+    """Importar los módulos con pasos adicionales (también en cada proceso del pool)"""
+    for module in modules:
+        importlib.import_module(module)
+
+
+def init_worker(plugins, parent):
+    """Inicializador de cada proceso del pool"""
+    # Con fork se heredan los manejadores de señales del servidor: SIGTERM
+    # vuelve a terminar el proceso y Ctrl+C lo atiende sólo el worker
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    load_plugins(plugins)
+    threading.Thread(target=watch_parent, args=(parent,), daemon=True).start()
+
+
+def watch_parent(parent):
+    # Si el worker muere sin cerrar el pool este proceso no debe quedar huérfano
+    # (con fork conserva además el socket del servidor)
+    while True:
+        time.sleep(PARENT_CHECK_INTERVAL)
+        if os.getppid() != parent:
+            os._exit(0)
+
+
+def run_step(name, path, info):
+    return STEPS[name](path, info)
+
+
+def open_content(path, info):
+    """Abrir el contenido original, descomprimiendo si se guardó en gzip"""
+    return gzip.open(path, 'rb') if info['compressed'] else open(path, 'rb')
+
+
+def read_head(path, info):
+    with open_content(path, info) as f:
+        return f.read(HEAD_SIZE)
+
+
+MAGIC = (
+    (b'%PDF', 'application/pdf'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF8', 'image/gif'),
+    (b'PK\x03\x04', 'application/zip'),
+    (b'\x1f\x8b', 'application/gzip'),
+    (b'BZh', 'application/x-bzip2'),
+    (b'\xfd7zXZ\x00', 'application/x-xz'),
+    (b'7z\xbc\xaf\x27\x1c', 'application/x-7z-compressed'),
+    (b'Rar!', 'application/vnd.rar'),
+    (b'\xd0\xcf\x11\xe0', 'application/x-ole-storage'),  # doc, xls, ppt antiguos
+    (b'OggS', 'audio/ogg'),
+    (b'ID3', 'audio/mpeg'),
+    (b'{\\rtf', 'application/rtf'),
+)
+
+
+def sniff(head):
+    """Tipo MIME según los primeros bytes"""
+    for magic, mime in MAGIC:
+        if head.startswith(magic):
+            return mime
+    if head[4:8] == b'ftyp':
+        return 'video/mp4'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    if head[257:262] == b'ustar':
+        return 'application/x-tar'
+    if b'\x00' in head:
+        return 'application/octet-stream'
+    try:
+        # Decodificador incremental: un carácter cortado al final no es error
+        text = codecs.getincrementaldecoder('utf-8')().decode(head).lstrip().lower()
+    except UnicodeDecodeError:
+        return 'application/octet-stream'
+    if text.startswith(('<!doctype html', '<html')):
+        return 'text/html'
+    if text.startswith('<?xml'):
+        return 'application/xml'
+    return 'text/plain'
+
+
+ENCODING_TYPES = {'gzip': 'application/gzip', 'bzip2': 'application/x-bzip2', 'xz': 'application/x-xz'}
+
+
+@step('mime')
+def detect_mime(path, info):
+    """Tipo real del contenido y si coincide con el que indica la extensión"""
+    detected = sniff(read_head(path, info))
+    declared, encoding = mimetypes.guess_type(info['name'])
+    # x.tar.gz se declara como tar con codificación gzip: lo primero es el gzip
+    declared = ENCODING_TYPES.get(encoding, declared)
+    matches = declared == detected
+    if declared and not matches:
+        # docx, xlsx, odt... son zip; csv, json, js... son texto
+        if detected == 'application/zip' and ('officedocument' in declared or 'opendocument' in declared):
+            matches = True
+        elif detected == 'text/plain' and (declared.startswith('text/') or declared in (
+                'application/json', 'application/javascript', 'application/xml')):
+            matches = True
+    return {'detected': detected, 'declared': declared, 'matches': matches}
+
+
+@step('checksum')
+def verify_checksum(path, info):
+    """Releer el contenido guardado y compararlo con el SHA-256 de la subida"""
+    sha256 = hashlib.sha256()
+    size = 0
+    with open_content(path, info) as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+            size += len(chunk)
+    digest = sha256.hexdigest()
+    result = {'sha256': digest, 'size': size,
+              'ok': size == info['size'] and info['sha256'] in (None, digest)}
+    if info['sha256'] is not None:
+        result['expected'] = info['sha256']
+    return result
+
+
+PDF_COUNT_RE = re.compile(rb'/Type\s*/Pages\b[^>]*?/Count\s+(\d+)|/Count\s+(\d+)[^>]*?/Type\s*/Pages\b')
+PDF_PAGE_RE = re.compile(rb'/Type\s*/Page\b')
+
+
+@step('pdf_pages')
+def count_pdf_pages(path, info):
+    """Número de páginas de un PDF"""
+    if not read_head(path, info).startswith(b'%PDF'):
+        return None
+    if pypdf is not None:
+        try:
+            with open_content(path, info) as f:
+                return {'pages': len(pypdf.PdfReader(f).pages)}
+        except Exception:
+            pass  # PDF dañado para pypdf: se intenta a mano
+
+    if info['compressed']:
+        with open_content(path, info) as f:
+            return scan_pdf_pages(f.read(PDF_MAX_READ))
+    # mmap: el PDF no se copia entero a memoria para buscar en él
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return scan_pdf_pages(data)
+
+
+def scan_pdf_pages(data):
+    # El nodo raíz /Pages lleva en /Count el total: es el mayor de todos
+    counts = [int(a or b) for a, b in PDF_COUNT_RE.findall(data)]
+    if counts:
+        return {'pages': max(counts)}
+    pages = len(PDF_PAGE_RE.findall(data))
+    if pages:
+        return {'pages': pages}
+    # Árbol de páginas dentro de streams comprimidos: hace falta pypdf
+    return {'pages': None, 'error': 'No se pudieron contar las páginas'}
+
+
+@step('archive')
+def list_archive(path, info):
+    """Contenido de un zip o tar (también tar.gz, tar.bz2 y tar.xz)"""
+    mime = sniff(read_head(path, info))
+    with open_content(path, info) as f:
+        if mime == 'application/zip':
+            try:
+                with zipfile.ZipFile(f) as archive:
+                    entries = [(i.filename, i.file_size) for i in archive.infolist() if not i.is_dir()]
+            except zipfile.BadZipFile as e:
+                return {'format': 'zip', 'error': str(e)}
+            return archive_summary('zip', entries)
+
+        if mime not in ('application/x-tar', 'application/gzip', 'application/x-bzip2', 'application/x-xz'):
+            return None
+        # Un tar sólo se conoce leyéndolo entero: se para tras ARCHIVE_MAX_ENTRIES
+        entries = []
+        try:
+            with tarfile.open(fileobj=f, mode='r:*') as archive:
+                for member in archive:
+                    if member.isfile():
+                        entries.append((member.name, member.size))
+                        if len(entries) > ARCHIVE_MAX_ENTRIES:
+                            break
+        except tarfile.TarError:
+            if not entries:
+                return None  # gzip/bzip2/xz de un solo archivo, no un tar
+        return archive_summary('tar', entries, complete=len(entries) <= ARCHIVE_MAX_ENTRIES)
+
+
+def archive_summary(kind, entries, complete=True):
+    """count y size son None si el listado se cortó antes del final"""
+    return {
+        'format': kind,
+        'count': len(entries) if complete else None,
+        'size': sum(size for _, size in entries) if complete else None,
+        'entries': [{'name': name, 'size': size} for name, size in entries[:ARCHIVE_MAX_ENTRIES]],
+        'truncated': len(entries) > ARCHIVE_MAX_ENTRIES,
+    }
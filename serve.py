@@ -0,0 +1,132 @@
+"""Arranque de producción: varios procesos uvicorn sirviendo la app Flask.
+
+    python serve.py --workers 4 --port 8090
+    python serve.py --asgi       # /upload y /files asíncronos (asgi.py)
+
+Cada proceso trabajador importa app.py por su cuenta; el índice de /files
+se mantiene al día entre procesos a través del registro de cambios.
+"""
+import asyncio
+import json
+import os
+
+import click
+import uvicorn
+from uvicorn.middleware.wsgi import WSGIMiddleware  # usa a2wsgi si está instalado
+
+
+class RequestTimeout:
+    """Middleware ASGI que responde 504 si una petición pasa demasiado tiempo
+    sin actividad.
+    
+    Cuenta como actividad cada bloque del cuerpo recibido y cada mensaje de
+    respuesta enviado, así una subida lenta por una red móvil o una descarga
+    larga (/export, /events) no se corta mientras avance.
+    """
+    
+    def __init__(self, app, timeout):
+        self.app = app
+        self.timeout = timeout
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not self.timeout:
+            await self.app(scope, receive, send)
+            return
+        
+        loop = asyncio.get_running_loop()
+        started = False
+        last_activity = loop.time()
+        
+        async def receive_wrapper():
+            nonlocal last_activity
+            message = await receive()
+            last_activity = loop.time()
+            return message
+        
+        async def send_wrapper(message):
+            nonlocal started, last_activity
+            if message['type'] == 'http.response.start':
+                started = True
+            await send(message)
+            last_activity = loop.time()
+        
+        task = asyncio.ensure_future(self.app(scope, receive_wrapper, send_wrapper))
+        try:
+            while True:
+                remaining = last_activity + self.timeout - loop.time()
+                if remaining <= 0:
+                    break
+                done, _ = await asyncio.wait({task}, timeout=remaining)
+                if done:
+                    task.result()
+                    return
+        finally:
+            if not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        
+        # Si la respuesta ya empezó sólo queda cortar la conexión
+        if started:
+            raise asyncio.TimeoutError()
+        body = json.dumps({'error': 'Tiempo de espera agotado'}).encode('utf-8')
+        await send({
+            'type': 'http.response.start',
+            'status': 504,
+            'headers': [(b'content-type', b'application/json'),
+                        (b'content-length', str(len(body)).encode('ascii')),
+                        (b'connection', b'close')],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+
+def create_app():
+    """Fábrica que uvicorn llama dentro de cada proceso trabajador"""
+    timeout = float(os.environ.get('SERVE_REQUEST_TIMEOUT', 300))
+    if os.environ.get('SERVE_ASGI') == '1':
+        from asgi import api
+        return RequestTimeout(api, timeout)
+    
+    from app import app, start_services
+    start_services()
+    threads = int(os.environ.get('SERVE_THREADS', 16))
+    return RequestTimeout(WSGIMiddleware(app, workers=threads), timeout)
+
+
+@click.command()
+@click.option('--host', default='0.0.0.0', show_default=True)
+@click.option('--port', type=int, default=lambda: int(os.environ.get('PORT', 8090)),
+              help='Puerto (por defecto $PORT o 8090).')
+@click.option('--workers', type=int,
+              default=lambda: int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1)),
+              help='Procesos trabajadores (por defecto $WEB_CONCURRENCY o un proceso por núcleo).')
+@click.option('--threads', type=int, default=16, show_default=True,
+              help='Hilos por proceso para ejecutar la app Flask.')
+@click.option('--keep-alive', type=int, default=5, show_default=True,
+              help='Segundos que se mantiene abierta una conexión inactiva.')
+@click.option('--timeout', type=float, default=300, show_default=True,
+              help='Segundos máximos sin actividad por petición (0 = sin límite).')
+@click.option('--asgi', is_flag=True,
+              help='Servir /upload y /files con la app asíncrona de asgi.py.')
+def main(host, port, workers, threads, keep_alive, timeout, asgi):
+    """Servidor de producción de la app de subida de archivos"""
+    # Los procesos trabajadores heredan el entorno, así reciben la configuración
+    os.environ['SERVE_THREADS'] = str(threads)
+    os.environ['SERVE_REQUEST_TIMEOUT'] = str(timeout)
+    os.environ['SERVE_ASGI'] = '1' if asgi else '0'
+    
+    uvicorn.run(
+        'serve:create_app',
+        factory=True,
+        host=host,
+        port=port,
+        workers=workers,
+        timeout_keep_alive=keep_alive,
+        proxy_headers=True,
+    )
+
+
+if __name__ == '__main__':
+    main()
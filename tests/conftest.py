@@ -0,0 +1,12 @@
+"""Configuración común de las pruebas.
+
+app.py crea sus carpetas (uploads/, .journal...) relativas al directorio
+actual en cuanto se importa: las pruebas se ejecutan en un directorio
+temporal para no tocar las del repositorio.
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp(prefix='upload-tests-'))
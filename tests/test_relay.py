@@ -0,0 +1,132 @@
+"""Cola de reenvío (RelayQueue) contra un servidor HTTP local que hace de
+procesador externo."""
+import http.server
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import app as core
+
+
+class StandIn(http.server.ThreadingHTTPServer):
+    """Servidor que responde con los códigos de `statuses` por orden (el
+    último se repite) y guarda el cuerpo de cada petición"""
+    
+    def __init__(self, statuses):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.statuses = list(statuses)
+        self.bodies = []
+    
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/upload_pdf'
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, como el procesador real
+    
+    def do_POST(self):
+        self.server.bodies.append(self.rfile.read(int(self.headers['Content-Length'])))
+        status = self.server.statuses.pop(0) if len(self.server.statuses) > 1 else self.server.statuses[0]
+        body = json.dumps({'status': status}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stand_in(request):
+    server = StandIn(request.param)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def upload_folder(tmp_path, monkeypatch):
+    folder = tmp_path / 'uploads'
+    folder.mkdir()
+    monkeypatch.setitem(core.app.config, 'UPLOAD_FOLDER', str(folder))
+    monkeypatch.setitem(core.app.config, 'SHARDED_LAYOUT', False)
+    return folder
+
+
+def make_queue(tmp_path, url, max_attempts=3):
+    return core.RelayQueue(str(tmp_path / 'relay'), url, workers=1,
+                           max_attempts=max_attempts, backoff=0.01)
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return
+        time.sleep(0.02)
+    raise AssertionError('No se cumplió la condición a tiempo')
+
+
+def jobs(queue, sub):
+    folder = os.path.join(queue.folder, sub)
+    result = []
+    for name in sorted(os.listdir(folder)):
+        with open(os.path.join(folder, name), encoding='utf-8') as f:
+            result.append(json.load(f))
+    return result
+
+
+@pytest.mark.parametrize('stand_in', [[503, 200]], indirect=True)
+def test_retry_then_success(stand_in, upload_folder, tmp_path):
+    (upload_folder / 'informe.pdf').write_bytes(b'%PDF-1.4 contenido')
+    queue = make_queue(tmp_path, stand_in.url)
+    queue.enqueue('informe.pdf')
+    queue.start()
+    
+    wait_for(lambda: len(stand_in.bodies) == 2 and queue.status() == {'pending': 0, 'inflight': 0, 'failed': 0})
+    assert all(b'%PDF-1.4 contenido' in body for body in stand_in.bodies)
+    assert b'filename="informe.pdf"' in stand_in.bodies[1]
+
+
+@pytest.mark.parametrize('stand_in', [[400]], indirect=True)
+def test_client_error_goes_to_failed(stand_in, upload_folder, tmp_path):
+    (upload_folder / 'informe.pdf').write_bytes(b'%PDF-1.4 contenido')
+    queue = make_queue(tmp_path, stand_in.url)
+    queue.enqueue('informe.pdf')
+    queue.start()
+    
+    wait_for(lambda: queue.status()['failed'] == 1)
+    assert len(stand_in.bodies) == 1  # un 4xx no se reintenta
+    assert queue.status() == {'pending': 0, 'inflight': 0, 'failed': 1}
+    [job] = jobs(queue, 'failed')
+    assert job['name'] == 'informe.pdf'
+    assert job['attempts'] == 1
+    assert job['error'] == 'Respuesta 400'
+
+
+def test_recover_requeues_jobs_of_dead_processes(tmp_path):
+    queue = make_queue(tmp_path, 'http://127.0.0.1:9/upload_pdf')
+    dead = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'],
+                          capture_output=True, text=True, check=True)
+    dead_pid = int(dead.stdout)
+    inflight = tmp_path / 'relay' / 'inflight'
+    orphan = f'{int(time.time() * 1000):013d}-{"a" * 32}.json'
+    mine = f'{int(time.time() * 1000):013d}-{"b" * 32}.json'
+    (inflight / f'{dead_pid}-{orphan}').write_text(json.dumps({'name': 'a.pdf', 'attempts': 1}))
+    (inflight / f'{os.getpid()}-{mine}').write_text(json.dumps({'name': 'b.pdf', 'attempts': 0}))
+    (inflight / 'basura.txt').write_text('no es un trabajo')
+    
+    queue._recover()
+    
+    assert os.listdir(tmp_path / 'relay' / 'pending') == [orphan]
+    assert sorted(os.listdir(inflight)) == sorted([f'{os.getpid()}-{mine}', 'basura.txt'])
+    assert jobs(queue, 'pending') == [{'name': 'a.pdf', 'attempts': 1}]